@@ -0,0 +1,293 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+
+import pygame
+
+import engine
+from engine import Vector2
+from game import SpaceShooter, GameState, MenuState, AppearShootEnemy
+
+
+# presses and releases keys through Game.handle_event so scripted runs take the same path as real input
+class ScriptedInput:
+    def __init__(self, game: engine.Game):
+        self.game = game
+        self.held = set()
+
+    def hold(self, keys):
+        keys = set(keys)
+        for key in self.held - keys:
+            self.game.handle_event(pygame.event.Event(pygame.KEYUP, key=key))
+        for key in keys - self.held:
+            self.game.handle_event(pygame.event.Event(pygame.KEYDOWN, key=key))
+        self.held = keys
+
+
+# weaves left and right across the screen while holding fire
+def strafe_and_shoot(tick, state):
+    keys = {pygame.K_SPACE}
+    if math.sin(tick / 40) > 0:
+        keys.add(pygame.K_LEFT)
+    else:
+        keys.add(pygame.K_RIGHT)
+    return keys
+
+
+# stand-in for a bullet when an enemy is killed directly
+class ScriptedShot:
+    def __init__(self):
+        self.velocity = Vector2(0, -10)
+        self.dead = False
+
+
+def setup_play(game):
+    state = GameState(game)
+    game.set_state(state)
+    state.tutorialTimer = 0
+    return state
+
+
+def setup_triple_shot(game):
+    state = setup_play(game)
+    state.player.power = 30
+    state.start_wave("wave3")
+    return state
+
+
+def setup_menu(game):
+    state = MenuState(game)
+    game.set_state(state)
+    return state
+
+
+# sweeps the mouse over the menu buttons so their hover state keeps changing
+def script_menu(tick, state):
+    state.game.handle_event(pygame.event.Event(pygame.MOUSEMOTION, pos=(400, 250 + (tick * 3) % 350)))
+    return set()
+
+
+def script_explosions(tick, state):
+    # a full row of enemies is spawned and killed every 20 ticks
+    if tick % 20 == 0:
+        for i in range(8):
+            e = AppearShootEnemy(state, Vector2(state.game.resolution[0] / 9 * (i + 1), 200))
+            while not e.dead:
+                e.on_hit(ScriptedShot())
+    return set()
+
+
+SCENARIOS = {
+    # wave1 hands over to wave2 at tick 600 and to wave3 at tick 1600
+    "layouts": (setup_play, strafe_and_shoot, 3000),
+    "triple_shot": (setup_triple_shot, strafe_and_shoot, 2000),
+    "explosions": (setup_play, script_explosions, 1000),
+    "menu": (setup_menu, script_menu, 1000),
+}
+
+
+# counts constructions of the engine math types, the returned function undoes the patching
+def count_allocations(counts):
+    originals = {}
+    for cls in (engine.Vector2, engine.Rectangle, engine.Circle):
+        originals[cls] = cls.__init__
+        counts[cls.__name__] = 0
+
+        def counting_init(self, *args, original=cls.__init__, name=cls.__name__):
+            counts[name] += 1
+            original(self, *args)
+
+        cls.__init__ = counting_init
+
+    def restore():
+        for cls, original in originals.items():
+            cls.__init__ = original
+
+    return restore
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_scenario(name: str, seed: int, ticks: int = None, allocations: bool = False, dirty_rects: bool = False,
+                 capture: str = None, precise_collisions: bool = False):
+    setup, script, default_ticks = SCENARIOS[name]
+    ticks = ticks or default_ticks
+    random.seed(seed)
+    game = SpaceShooter((800, 600), headless=True)
+    game.set_dirty_rects(dirty_rects)
+    game.preciseCollisions = precise_collisions
+    if capture is not None:
+        game.start_capture(capture, wait=True)
+    state = setup(game)
+    playing = isinstance(state, GameState)
+    keyboard = ScriptedInput(game)
+    game.timer.reset()
+    game.timer.enabled = True
+    counts = {}
+    restore = count_allocations(counts) if allocations else None
+
+    frame_times = []
+    try:
+        for tick in range(ticks):
+            start = time.perf_counter()
+            keyboard.hold(script(tick, state))
+            # keep the player alive so every scenario runs for its full length
+            if playing:
+                state.player.lives = 3
+            game.update()
+            game.draw()
+            game.present()
+            frame_times.append((time.perf_counter() - start) * 1000)
+    finally:
+        if restore is not None:
+            restore()
+    return summarize(game, seed, dirty_rects, precise_collisions, frame_times, counts if allocations else None)
+
+
+# a recorded session as a workload, its input is fed back exactly as it was handled while recording
+def run_replay(path: str, allocations: bool = False, dirty_rects: bool = False, capture: str = None,
+               precise_collisions: bool = False):
+    replay = engine.InputReplay(path)
+    game = SpaceShooter((800, 600), headless=True)
+    game.set_dirty_rects(dirty_rects)
+    game.preciseCollisions = precise_collisions
+    if capture is not None:
+        game.start_capture(capture, wait=True)
+    random.seed(replay.seed)
+    if replay.resolution != tuple(game.resolution):
+        game.set_resolution(replay.resolution)
+    game.timer.reset()
+    game.timer.enabled = True
+    counts = {}
+    restore = count_allocations(counts) if allocations else None
+
+    frame_times = []
+    try:
+        for tick in range(replay.ticks):
+            start = time.perf_counter()
+            for event in replay.events_at(tick):
+                game.handle_event(event)
+            game.update()
+            game.draw()
+            game.present()
+            frame_times.append((time.perf_counter() - start) * 1000)
+    finally:
+        if restore is not None:
+            restore()
+    return summarize(game, replay.seed, dirty_rects, precise_collisions, frame_times,
+                     counts if allocations else None)
+
+
+def summarize(game, seed: int, dirty_rects: bool, precise_collisions: bool, frame_times, counts=None):
+    ticks = len(frame_times)
+    state = game.state
+    result = {
+        "ticks": ticks,
+        "seed": seed,
+        "dirty_rects": dirty_rects,
+        "precise_collisions": precise_collisions,
+        "frame_ms": {"mean": sum(frame_times) / len(frame_times), "p50": percentile(frame_times, 0.5),
+                     "p95": percentile(frame_times, 0.95), "max": max(frame_times)},
+        "phases": game.timer.results(),
+    }
+    if isinstance(state, GameState):
+        result["final"] = {"score": state.score, "objects": len(state.objects), "projectiles": len(state.projectiles),
+                           "enemy_bullets": len(state.enemyBullets), "enemies": len(state.enemies),
+                           "particles": len(state.particles)}
+        result["pools"] = {"player_bullets": state.playerBullets.stats()}
+        if precise_collisions:
+            result["masks"] = game.masks.stats()
+    if counts is not None:
+        result["allocations_per_tick"] = {name: count / ticks for name, count in counts.items()}
+    game.quit()
+    return result
+
+
+# returns a list of (scenario, phase, baseline_ms, current_ms) for every phase that got slower than allowed
+def compare(results, baseline, tolerance: float):
+    regressions = []
+    for name, result in results["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+        for phase, timing in result["phases"].items():
+            base_timing = base["phases"].get(phase)
+            if base_timing is None:
+                continue
+            if timing["mean_ms"] > base_timing["mean_ms"] * (1 + tolerance):
+                regressions.append((name, phase, base_timing["mean_ms"], timing["mean_ms"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Space Shooter benchmarks")
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run, any of {} (default: all)".format(
+        ", ".join(SCENARIOS)))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--ticks", type=int, help="override the tick count of every scenario")
+    parser.add_argument("--output", default="bench_results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--allocations", action="store_true",
+                        help="run every scenario a second time counting Vector2/Rectangle/Circle allocations per tick")
+    parser.add_argument("--replay", action="append", default=[], metavar="PATH",
+                        help="also run a session recorded with game.py --record, can be given more than once")
+    parser.add_argument("--capture", metavar="DIRECTORY",
+                        help="also write every frame of every workload to DIRECTORY/<name>.rgb (raw rgb24, 800x600), "
+                             "waiting on the writer slows the runs down")
+    parser.add_argument("--dirty-rects", action="store_true", help="render with dirty rectangle updates")
+    parser.add_argument("--precise-collisions", action="store_true",
+                        help="test sprite masks after the hitboxes, like the precise_collisions setting")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="allowed slowdown of a phase's mean time before it counts as a regression")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: {}".format(name))
+
+    results = {"python": platform.python_version(), "pygame": pygame.version.ver, "scenarios": {}}
+    workloads = [(name, run_scenario, (name, args.seed, args.ticks))
+                 for name in args.scenarios or ([] if args.replay else list(SCENARIOS))]
+    workloads += [("replay:" + os.path.basename(path), run_replay, (path,)) for path in args.replay]
+    for name, run, run_args in workloads:
+        capture = None
+        if args.capture:
+            os.makedirs(args.capture, exist_ok=True)
+            capture = os.path.join(args.capture, name.replace(":", "_") + ".rgb")
+        result = run(*run_args, dirty_rects=args.dirty_rects, capture=capture,
+                     precise_collisions=args.precise_collisions)
+        results["scenarios"][name] = result
+        print("{}: {:.3f} ms/frame mean, {:.3f} ms p95".format(name, result["frame_ms"]["mean"],
+                                                                result["frame_ms"]["p95"]))
+        for phase, timing in sorted(result["phases"].items()):
+            print("  {:<12} {:8.3f} ms mean {:8.3f} ms max".format(phase, timing["mean_ms"], timing["max_ms"]))
+        if args.allocations:
+            # the counting wrappers slow everything down, so they get their own run
+            allocations = run(*run_args, allocations=True, dirty_rects=args.dirty_rects,
+                              precise_collisions=args.precise_collisions)["allocations_per_tick"]
+            result["allocations_per_tick"] = allocations
+            for kind, count in sorted(allocations.items()):
+                print("  {:<12} {:8.2f} allocations/tick".format(kind, count))
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, phase, before, after in regressions:
+            print("regression in {}/{}: {:.3f} ms -> {:.3f} ms".format(name, phase, before, after))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
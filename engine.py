@@ -1,18 +1,42 @@
+import ast
+import gc
+import heapq
 import json
 import math
-
+import mmap
+import operator
+import os
+import queue
+import random
+import struct
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
 import pygame
 
+# for the cold start time, as close to process start as the engine gets
+STARTED = time.perf_counter()
+
 
+# is_down/is_up give the held state, was_pressed/was_released are only true for the tick the key changed on
 class KeyHandler:
     def __init__(self):
         self.keys = {}
+        self.pressed = set()
+        self.released = set()
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN:
             self.keys[event.key] = True
+            self.pressed.add(event.key)
         elif event.type == pygame.KEYUP:
             self.keys[event.key] = False
+            self.released.add(event.key)
 
     def is_pressed(self, key):
         return self.keys.get(key, False)
@@ -26,20 +50,40 @@ class KeyHandler:
     def is_up(self, key):
         return not self.keys.get(key, False)
 
+    def was_pressed(self, key):
+        return key in self.pressed
+
+    def was_released(self, key):
+        return key in self.released
+
+    # called by Game.update after every tick
+    def end_tick(self):
+        if self.pressed:
+            self.pressed.clear()
+        if self.released:
+            self.released.clear()
+
     def reset(self):
         self.keys = {}
+        self.pressed.clear()
+        self.released.clear()
 
 
+# same as KeyHandler for mouse buttons
 class MouseHandler:
     def __init__(self):
         self.buttons = {}
+        self.pressed = set()
+        self.released = set()
         self.mouse_position = Vector2(0, 0)
 
     def handle_event(self, event):
         if event.type == pygame.MOUSEBUTTONDOWN:
             self.buttons[event.button] = True
+            self.pressed.add(event.button)
         elif event.type == pygame.MOUSEBUTTONUP:
             self.buttons[event.button] = False
+            self.released.add(event.button)
         elif event.type == pygame.MOUSEMOTION:
             self.mouse_position = Vector2(event.pos[0], event.pos[1])
 
@@ -55,57 +99,306 @@ class MouseHandler:
     def is_up(self, button):
         return not self.buttons.get(button, False)
 
+    def was_pressed(self, button):
+        return button in self.pressed
+
+    def was_released(self, button):
+        return button in self.released
+
     def get_mouse_position(self):
         return self.mouse_position
 
+    def end_tick(self):
+        if self.pressed:
+            self.pressed.clear()
+        if self.released:
+            self.released.clear()
+
     def reset(self):
         self.buttons = {}
+        self.pressed.clear()
+        self.released.clear()
+
+
+# events posted during a frame are held until dispatch, which a state runs at the start of its update
+# subscribers get the events of one type, optionally only for one key or mouse button, or every event
+# when no type is given; only the last MOUSEMOTION of a tick is delivered
+class EventBus:
+    def __init__(self):
+        self.handlers = {}
+        self.wildcard = []
+        self.queue = []
+        self.motion = None
+
+    def subscribe(self, callback, event_type: int = None, key: int = None):
+        if event_type is None:
+            self.wildcard.append(callback)
+        else:
+            self.handlers.setdefault(event_type, []).append((key, callback))
+
+    def unsubscribe(self, callback):
+        if callback in self.wildcard:
+            self.wildcard.remove(callback)
+        for event_type, handlers in self.handlers.items():
+            self.handlers[event_type] = [(key, handler) for key, handler in handlers if handler != callback]
+
+    def post(self, event):
+        if event.type == pygame.MOUSEMOTION:
+            if self.motion is not None:
+                self.queue[self.motion] = None
+            self.motion = len(self.queue)
+        self.queue.append(event)
+
+    def dispatch(self):
+        if not self.queue:
+            return
+        queue = self.queue
+        self.queue = []
+        self.motion = None
+        for event in queue:
+            if event is None:
+                continue
+            handlers = self.handlers.get(event.type)
+            if handlers:
+                key = getattr(event, "key", None)
+                if key is None:
+                    key = getattr(event, "button", None)
+                for handler_key, handler in list(handlers):
+                    if handler_key is None or handler_key == key:
+                        handler(event)
+            for handler in list(self.wildcard):
+                handler(event)
+
+
+# binary input log: a header with the seed and resolution, then for every tick that had input its index,
+# the number of events and the events themselves, ended by a record with the total tick count and no events
+RECORDING_MAGIC = b"SSIR"
+RECORDING_VERSION = 1
+RECORDING_HEADER = struct.Struct("<4sHQHH")
+RECORDING_TICK = struct.Struct("<IH")
+RECORDING_EVENT = struct.Struct("<BIhh")
+RECORDING_FLUSH_TICKS = 60
+RECORDED_EVENTS = (pygame.KEYDOWN, pygame.KEYUP, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP, pygame.MOUSEMOTION)
+
+
+# writes every input event handled by the game to a file, grouped by the tick it was handled in
+class InputRecorder:
+    def __init__(self, path: str, seed: int, resolution: (int, int)):
+        self.file = open(path, "wb")
+        self.file.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, seed, resolution[0], resolution[1]))
+        self.tick = 0
+        self.pending = []
+
+    def record(self, event):
+        if event.type not in RECORDED_EVENTS:
+            return
+        kind = RECORDED_EVENTS.index(event.type)
+        if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+            self.pending.append(RECORDING_EVENT.pack(kind, event.key, 0, 0))
+        elif event.type == pygame.MOUSEMOTION:
+            self.pending.append(RECORDING_EVENT.pack(kind, 0, event.pos[0], event.pos[1]))
+        else:
+            self.pending.append(RECORDING_EVENT.pack(kind, event.button, event.pos[0], event.pos[1]))
+
+    def end_tick(self):
+        if self.pending:
+            self.file.write(RECORDING_TICK.pack(self.tick, len(self.pending)))
+            self.file.write(b"".join(self.pending))
+            self.pending = []
+        self.tick += 1
+        # so a crash loses at most the last second or so
+        if self.tick % RECORDING_FLUSH_TICKS == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.write(RECORDING_TICK.pack(self.tick, 0))
+        self.file.close()
+
+
+# reads a file written by InputRecorder back into pygame events
+class InputReplay:
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            data = file.read()
+        if len(data) < RECORDING_HEADER.size:
+            raise ValueError("{} is not a version {} input recording".format(path, RECORDING_VERSION))
+        magic, version, self.seed, width, height = RECORDING_HEADER.unpack_from(data)
+        if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+            raise ValueError("{} is not a version {} input recording".format(path, RECORDING_VERSION))
+        self.resolution = (width, height)
+        self.events = {}
+        self.ticks = 0
+        # a recording cut off by a crash has no closing record, it then plays up to its last complete tick
+        self.truncated = True
+        offset = RECORDING_HEADER.size
+        while offset + RECORDING_TICK.size <= len(data):
+            tick, count = RECORDING_TICK.unpack_from(data, offset)
+            offset += RECORDING_TICK.size
+            if count == 0:
+                self.ticks = tick
+                self.truncated = False
+                break
+            end = offset + count * RECORDING_EVENT.size
+            if end > len(data):
+                break
+            events = []
+            for kind, code, x, y in RECORDING_EVENT.iter_unpack(data[offset:end]):
+                if kind >= len(RECORDED_EVENTS):
+                    break
+                event_type = RECORDED_EVENTS[kind]
+                if event_type in (pygame.KEYDOWN, pygame.KEYUP):
+                    events.append(pygame.event.Event(event_type, key=code))
+                elif event_type == pygame.MOUSEMOTION:
+                    events.append(pygame.event.Event(event_type, pos=(x, y)))
+                else:
+                    events.append(pygame.event.Event(event_type, button=code, pos=(x, y)))
+            if len(events) < count:
+                break
+            offset = end
+            self.events[tick] = events
+            self.ticks = tick + 1
+
+    def events_at(self, tick: int):
+        return self.events.get(tick, ())
 
 
 class Game:
-    def __init__(self, resolution: (int, int)):
+    def __init__(self, resolution: (int, int), headless: bool = False):
+        # headless games use SDL's dummy video driver, the screen is then just an offscreen surface
+        self.headless = headless
+        if self.headless:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+            os.environ["SDL_AUDIODRIVER"] = "dummy"
+        # shared by every state so there is a single render queue
+        self.renderer = Renderer(self)
         self.state = GameState(self)
         self.state.game = self
         self.keyboard = KeyHandler()
         self.mouse = MouseHandler()
         self.settings = SettingsHandler(self)
         self.paused = False
+        # fps caps how often frames are drawn, the game logic always steps at tick_rate
         self.fps = 60
+        self.tick_rate = 60
+        # most logic steps run in one frame to catch up, past that the game slows down instead of spiraling
+        self.max_steps = 5
+        # how far between the last two logic steps the current frame is, used to interpolate positions
+        self.alpha = 1.0
         self.fps_clock = pygame.time.Clock()
         self.fps_clock.tick(self.fps)
         self.objects = []
+        self.assets = AssetManager(self)
+        self.timer = FrameTimer()
+        self.fonts = FontCache()
+        self.rotations = RotationCache()
+        self.masks = MaskCache()
+        self.dirty_rects = None
+        self.overlay = ProfilerOverlay(self)
+        self.trace_path = "trace.json"
+        self.recorder = None
+        self.capture = None
 
         self.resolution = resolution
         self.screen = pygame.display.set_mode(self.resolution)
-        self.renderer = Renderer(self)
         pygame.init()
 
     def set_resolution(self, resolution):
         self.resolution = resolution
         self.screen = pygame.display.set_mode(self.resolution)
+        if self.dirty_rects is not None:
+            self.dirty_rects.invalidate()
+
+    # opt-in, only the parts of the screen touched by the Renderer are pushed to the display
+    def set_dirty_rects(self, enabled: bool):
+        self.dirty_rects = DirtyRects(self) if enabled else None
 
     def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_F3:
+                self.overlay.toggle()
+            elif event.key == pygame.K_F4:
+                self.toggle_trace()
+        if self.recorder is not None:
+            self.recorder.record(event)
         self.keyboard.handle_event(event)
         self.mouse.handle_event(event)
         self.state.handle_event(event)
 
+    # F4 starts recording a trace, pressing it again writes it to trace_path
+    def toggle_trace(self):
+        if self.timer.tracing:
+            self.timer.stop_trace(self.trace_path)
+            self.timer.enabled = self.overlay.visible
+        else:
+            self.timer.start_trace()
+
     def update(self):
-        if self.paused:
-            return
-        self.state.update()
+        if self.assets.loading:
+            self.assets.poll()
+        if not self.paused:
+            with self.timer.scope("update"):
+                self.state.update()
+        self.keyboard.end_tick()
+        self.mouse.end_tick()
+        if self.recorder is not None:
+            self.recorder.end_tick()
+
+    # logs the input of every tick from now on, seeding random so the session can be replayed exactly
+    def start_recording(self, path: str, seed: int = None):
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        # recordings store the seed as an unsigned 64-bit field, seeding with the stored value keeps replays exact
+        seed %= 2 ** 64
+        random.seed(seed)
+        self.recorder = InputRecorder(path, seed, self.resolution)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    # every drawn frame is handed to a FrameCapture writing to path, see FrameCapture for the formats
+    def start_capture(self, path: str, capture_format: str = "raw", queue_size: int = 8, wait: bool = False):
+        self.stop_capture()
+        self.capture = FrameCapture(path, self.renderer.target, capture_format, queue_size, wait)
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            if self.capture.error is not None:
+                self.handle_error(self.capture.error)
+            print("captured {} frames to {}, dropped {}".format(self.capture.written, self.capture.path,
+                                                               self.capture.dropped))
+            self.capture = None
 
     def draw(self):
-        self.state.draw()
+        with self.timer.scope("draw"):
+            self.state.draw()
+            self.renderer.flush()
         # pause menu
         if self.paused:
-            pygame.draw.rect(self.screen, (255, 255, 255), (0, 0, self.resolution[0], self.resolution[1]))
-            font = pygame.font.SysFont("Arial", 50)
-            text = font.render("Paused", True, (0, 0, 0))
-            self.screen.blit(text, (
+            if self.dirty_rects is not None:
+                self.dirty_rects.invalidate()
+            target = self.renderer.target
+            pygame.draw.rect(target, (255, 255, 255), (0, 0, self.resolution[0], self.resolution[1]))
+            font = self.fonts.get_font("Arial", 50)
+            text = self.fonts.render(font, "Paused", (0, 0, 0))
+            target.blit(text, (
             self.resolution[0] / 2 - text.get_width() / 2, self.resolution[1] / 2 - text.get_height() / 2))
-            text = font.render("Press P to unpause", True, (0, 0, 0))
-            self.screen.blit(text, (
+            text = self.fonts.render(font, "Press P to unpause", (0, 0, 0))
+            target.blit(text, (
             self.resolution[0] / 2 - text.get_width() / 2, self.resolution[1] / 2 - text.get_height() / 2 + 50))
+        if self.overlay.visible:
+            self.overlay.draw()
+        if self.capture is not None:
+            with self.timer.scope("capture"):
+                try:
+                    self.capture.capture(self.renderer.target)
+                except RuntimeError:
+                    if self.capture.error is None:
+                        raise
+                    # the writer failed, the game goes on without capturing
+                    self.stop_capture()
 
     def initialize(self):
         self.state.initialize()
@@ -113,34 +406,124 @@ class Game:
     def set_state(self, state):
         self.state = state
         self.state.game = self
+        if self.dirty_rects is not None:
+            self.dirty_rects.invalidate()
         self.initialize()
 
+    def present(self):
+        with self.timer.scope("present"):
+            if self.dirty_rects is None:
+                pygame.display.update()
+            else:
+                pygame.display.update(self.dirty_rects.collect())
+
+    def end_frame(self):
+        if self.timer.enabled:
+            self.timer.end_frame(self.state.entity_counts())
+
     def run(self):
         self.initialize()
+        step = 1 / self.tick_rate
+        accumulator = 0
+        last = time.perf_counter()
+        first_frame = True
         while True:
+            with self.timer.scope("handle_event"):
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        return
+                    self.handle_event(event)
+            now = time.perf_counter()
+            accumulator += now - last
+            last = now
+            steps = 0
+            while accumulator >= step and steps < self.max_steps:
+                self.update()
+                accumulator -= step
+                steps += 1
+            if accumulator >= step:
+                accumulator %= step
+            self.alpha = accumulator / step
+            self.draw()
+            self.present()
+            if first_frame:
+                first_frame = False
+                print("first frame after {:.0f} ms".format((time.perf_counter() - STARTED) * 1000))
+            self.end_frame()
+            self.fps_clock.tick(self.fps)
+
+    # steps the game as fast as possible without a frame cap, mostly for headless soak tests and benchmarks
+    def simulate(self, ticks: int, render: bool = False):
+        self.alpha = 1.0
+        start = time.perf_counter()
+        quitting = False
+        for tick in range(ticks):
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
-                    return
+                    quitting = True
+                    break
                 self.handle_event(event)
+            if quitting:
+                ticks = tick
+                break
             self.update()
-            self.draw()
-            pygame.display.update()
-            self.fps_clock.tick(self.fps)
+            if render:
+                self.draw()
+                # also collects the dirty rects, which would otherwise pile up
+                self.present()
+            self.end_frame()
+        elapsed = time.perf_counter() - start
+        return {"ticks": ticks, "seconds": elapsed, "ticks_per_second": ticks / elapsed if elapsed > 0 else 0}
+
+    # feeds a recorded session back through handle_event tick by tick, as fast as possible
+    def replay(self, replay: InputReplay, render: bool = False):
+        random.seed(replay.seed)
+        if replay.resolution != tuple(self.resolution):
+            self.set_resolution(replay.resolution)
+        self.alpha = 1.0
+        start = time.perf_counter()
+        for tick in range(replay.ticks):
+            for event in replay.events_at(tick):
+                self.handle_event(event)
+            self.update()
+            if render:
+                self.draw()
+                # also collects the dirty rects, which would otherwise pile up
+                self.present()
+            self.end_frame()
+        elapsed = time.perf_counter() - start
+        return {"ticks": replay.ticks, "seconds": elapsed,
+                "ticks_per_second": replay.ticks / elapsed if elapsed > 0 else 0}
 
     def handle_error(self, error: Exception):
         print(error)
 
     def quit(self):
+        self.stop_capture()
+        self.assets.shutdown()
+        self.stop_recording()
         self.settings.save()
         pygame.quit()
 
 
+# objects that override handle_event are subscribed to the state's EventBus, to every event unless
+# input_events lists the event types (or (type, key) pairs) they want
 class GameObject:
+    input_events = ()
+
     def __init__(self, state):
         self.state = state
         self.game = state.game
         self.state.objects.append(self)
         self.renderer = state.renderer
+        if type(self).handle_event is not GameObject.handle_event:
+            if not self.input_events:
+                state.events.subscribe(self.handle_event)
+            for entry in self.input_events:
+                if isinstance(entry, tuple):
+                    state.events.subscribe(self.handle_event, *entry)
+                else:
+                    state.events.subscribe(self.handle_event, entry)
 
     def handle_event(self, event):
         pass
@@ -159,34 +542,217 @@ class GameObject:
 
     def destroy(self):
         try:
-            self.state.objects.remove(self)
-            self.on_destroy()
+            if self.state.objects.remove(self):
+                if type(self).handle_event is not GameObject.handle_event:
+                    self.state.events.unsubscribe(self.handle_event)
+                self.on_destroy()
         except Exception as e:
             self.state.game.handle_error(e)
 
 
+# list of entities where removal is deferred until flush, so entities can be removed while it's being iterated
+# removed entities are skipped by iteration right away and dropped from the list in one pass on flush
+class EntityList:
+    def __init__(self):
+        self.items = []
+        self.removed = set()
+        self.pending = []
+
+    def __iter__(self):
+        removed = self.removed
+        for obj in self.items:
+            if id(obj) not in removed:
+                yield obj
+
+    def __len__(self):
+        return len(self.items) - len(self.pending)
+
+    def append(self, obj):
+        self.items.append(obj)
+
+    # returns False if the entity was already removed this tick
+    def remove(self, obj) -> bool:
+        key = id(obj)
+        if key in self.removed:
+            return False
+        self.removed.add(key)
+        self.pending.append(obj)
+        return True
+
+    # drops removed entities and returns them, so they can be released back to a pool
+    def flush(self):
+        if not self.pending:
+            return ()
+        removed = self.removed
+        self.items = [obj for obj in self.items if id(obj) not in removed]
+        flushed = self.pending
+        self.removed = set()
+        self.pending = []
+        return flushed
+
+    def clear(self):
+        self.items = []
+        self.removed = set()
+        self.pending = []
+
+
 class GameState:
     def __init__(self, game):
         self.game = game
-        self.renderer = Renderer(game)
-        self.objects = []
+        self.renderer = game.renderer
+        self.objects = EntityList()
+        self.events = EventBus()
 
+    # only queues the event, the subscribed objects get it when the next update dispatches
     def handle_event(self, event):
-        for obj in self.objects:
-            obj.handle_event(event)
+        self.events.post(event)
 
     def update(self):
-        for obj in self.objects:
-            obj.update()
+        self.events.dispatch()
+        timer = self.game.timer
+        if timer.enabled:
+            for obj in self.objects:
+                with timer.scope(type(obj).__name__ + ".update"):
+                    obj.update()
+        else:
+            for obj in self.objects:
+                obj.update()
+        self.objects.flush()
 
     def draw(self):
-        for obj in self.objects:
-            obj.draw()
+        timer = self.game.timer
+        if timer.enabled:
+            for obj in self.objects:
+                with timer.scope(type(obj).__name__ + ".draw"):
+                    obj.draw()
+        else:
+            for obj in self.objects:
+                obj.draw()
 
     def initialize(self):
         for obj in self.objects:
             obj.initialize()
 
+    # shown by the profiler overlay and written to traces
+    def entity_counts(self):
+        return {"objects": len(self.objects)}
+
+
+# position between the previous and the current logic step, for drawing in between steps
+def interpolate(previous, current, alpha: float):
+    if alpha >= 1:
+        return current
+    return previous + (current - previous) * alpha
+
+
+# keeps every particle in flat numpy buffers and moves them all in one step
+# particles die once they shrink to nothing or fall below the bottom of the screen
+class ParticleEmitter(GameObject):
+    def __init__(self, state, capacity: int = 256, layer: int = None):
+        super().__init__(state)
+        # particles are queued on this render layer, or drawn right away when it is None
+        self.layer = layer
+        self.count = 0
+        self.positions = numpy.zeros((capacity, 2))
+        self.previous = numpy.zeros((capacity, 2))
+        self.velocities = numpy.zeros((capacity, 2))
+        self.radii = numpy.zeros(capacity)
+        self.shrink = numpy.zeros(capacity)
+        self.colors = numpy.zeros((capacity, 3), dtype=numpy.uint8)
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, capacity: int):
+        if capacity <= len(self.radii):
+            return
+        capacity = max(capacity, len(self.radii) * 2)
+        for name in ("positions", "previous", "velocities", "radii", "shrink", "colors"):
+            old = getattr(self, name)
+            new = numpy.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def emit(self, x: float, y: float, vx: float, vy: float, radius: float, color: (int, int, int),
+             shrink: float = 0):
+        if self.count == len(self.radii):
+            self.reserve(self.count + 1)
+        i = self.count
+        self.positions[i] = (x, y)
+        self.previous[i] = (x, y)
+        self.velocities[i] = (vx, vy)
+        self.radii[i] = radius
+        self.shrink[i] = shrink
+        self.colors[i] = color
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def update(self):
+        n = self.count
+        if n == 0:
+            return
+        positions = self.positions[:n]
+        radii = self.radii[:n]
+        self.previous[:n] = positions
+        positions += self.velocities[:n]
+        radii -= self.shrink[:n]
+        alive = (radii > 0) & (positions[:, 1] <= self.game.resolution[1] + radii)
+        if alive.all():
+            return
+        keep = numpy.flatnonzero(alive)
+        k = len(keep)
+        for buffer in (self.positions, self.previous, self.velocities, self.radii, self.shrink, self.colors):
+            buffer[:k] = buffer[keep]
+        self.count = k
+
+    def draw(self):
+        n = self.count
+        if n == 0:
+            return
+        positions = interpolate(self.previous[:n], self.positions[:n], self.game.alpha)
+        if self.layer is None:
+            self.game.renderer.draw_circles(positions.astype(int).tolist(), self.radii[:n].astype(int).tolist(),
+                                            self.colors[:n].tolist())
+        else:
+            self.game.renderer.queue_circles(positions.astype(int).tolist(), self.radii[:n].astype(int).tolist(),
+                                             self.colors[:n].tolist(), self.layer)
+
+
+# a tile that scrolls down the screen and wraps around, one or two blits per frame however much is on it,
+# e.g. one parallax layer of a starfield
+class ScrollingLayer(GameObject):
+    def __init__(self, state, tile: pygame.Surface, speed: float):
+        super().__init__(state)
+        self.tile = tile
+        self.speed = speed
+        self.offset = 0.0
+        self.previous = 0.0
+
+    def update(self):
+        self.previous = self.offset
+        self.offset += self.speed
+        height = self.tile.get_height()
+        if self.offset >= height:
+            self.offset -= height
+            self.previous -= height
+
+    def draw(self):
+        height = self.tile.get_height()
+        y = int(self.previous + (self.offset - self.previous) * self.game.alpha)
+        target = self.renderer.target
+        if self.tile.get_width() >= target.get_width() and height >= target.get_height():
+            # a layer covering the screen would mark it twice over in rects, invalidate the frame instead
+            target.blit(self.tile, (0, y))
+            if y > 0:
+                target.blit(self.tile, (0, y - height))
+            self.renderer.mark_all()
+            return
+        self.renderer.draw_img(self.tile, Vector2(0, y))
+        if y > 0:
+            self.renderer.draw_img(self.tile, Vector2(0, y - height))
+
 
 # saves and reads settings from a json file
 class SettingsHandler:
@@ -225,9 +791,837 @@ class SettingsHandler:
         return len(self.settings) == 0
 
 
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tga")
+
+# files written next to the sprites by pack_assets.py, the raw pixel cache is written on the first load
+ATLAS_IMAGE = "atlas.png"
+ATLAS_INDEX = "atlas.json"
+ATLAS_RAW = "atlas.raw"
+# magic, width, height and the mtime and size of the atlas image the pixels were decoded from
+ATLAS_RAW_HEADER = struct.Struct("<4sHHQQ")
+ATLAS_RAW_MAGIC = b"SSAR"
+
+
+# atlas keys and lookups go through this, so ./assets/a.png and assets/a.png name the same sprite
+def asset_key(path: str) -> str:
+    return os.path.relpath(path).replace(os.sep, "/")
+
+
+# every sprite packed into one image, sprites are handed out as subsurfaces of it under their original path
+# the decoded pixels are cached in a raw file that is memory mapped on later starts instead of decoding the png
+class SpriteAtlas:
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, ATLAS_INDEX), "r") as file:
+            index = json.load(file)
+        self.directory = directory
+        self.rects = {asset_key(path): pygame.Rect(rect) for path, rect in index["sprites"].items()}
+        self.pixels = None
+        self.surface = self.load(os.path.join(directory, index["image"]), os.path.join(directory, ATLAS_RAW))
+        if pygame.display.get_surface() is not None:
+            self.surface = self.surface.convert_alpha()
+        self.sprites = {}
+
+    def load(self, image_path: str, raw_path: str):
+        stat = os.stat(image_path)
+        try:
+            with open(raw_path, "rb") as file:
+                self.pixels = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, width, height, mtime, size = ATLAS_RAW_HEADER.unpack_from(self.pixels)
+            if (magic == ATLAS_RAW_MAGIC and mtime == stat.st_mtime_ns and size == stat.st_size
+                    and len(self.pixels) == ATLAS_RAW_HEADER.size + width * height * 4):
+                return pygame.image.frombuffer(memoryview(self.pixels)[ATLAS_RAW_HEADER.size:], (width, height),
+                                               "RGBA")
+            self.pixels.close()
+        except (OSError, ValueError, struct.error):
+            pass
+        self.pixels = None
+        surface = pygame.image.load(image_path)
+        try:
+            with open(raw_path, "wb") as file:
+                file.write(ATLAS_RAW_HEADER.pack(ATLAS_RAW_MAGIC, surface.get_width(), surface.get_height(),
+                                                 stat.st_mtime_ns, stat.st_size))
+                file.write(pygame.image.tobytes(surface, "RGBA"))
+        except OSError:
+            pass
+        return surface
+
+    # true when a packed sprite changed after the atlas was built
+    def is_stale(self):
+        built = os.stat(os.path.join(self.directory, ATLAS_INDEX)).st_mtime_ns
+        for path in self.rects:
+            try:
+                if os.stat(path).st_mtime_ns > built:
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def get(self, path: str):
+        sprite = self.sprites.get(path)
+        if sprite is None:
+            rect = self.rects.get(asset_key(path))
+            if rect is None:
+                return None
+            sprite = self.surface.subsurface(rect)
+            self.sprites[path] = sprite
+        return sprite
+
+
+# loads every image once and hands out the same surface to everyone asking for it
+# preload_async decodes a whole directory on worker threads, poll picks up the finished ones on the main thread
+class AssetManager:
+    def __init__(self, game: Game):
+        self.game = game
+        self.images = {}
+        self.converted = set()
+        self.hits = 0
+        self.misses = 0
+        self.executor = None
+        self.pending = {}
+        self.preload_total = 0
+        self.preload_start = 0
+        self.preload_ms = None
+        self.atlas = None
+
+    @property
+    def loading(self):
+        return len(self.pending) > 0
+
+    def get_image(self, path: str) -> pygame.Surface:
+        image = self.images.get(path)
+        if image is None:
+            self.misses += 1
+            # still being decoded by the preload, wait for it instead of loading it a second time
+            future = self.pending.pop(path, None)
+            sprite = self.atlas.get(path) if self.atlas is not None else None
+            if sprite is not None:
+                # subsurfaces of the atlas are already in the display format
+                self.images[path] = sprite
+                self.converted.add(path)
+                return sprite
+            if future is None:
+                image = pygame.image.load(path)
+            else:
+                image = future.result()
+                if not self.pending:
+                    self.preload_ms = (time.perf_counter() - self.preload_start) * 1000
+            self.images[path] = image
+        else:
+            self.hits += 1
+        # convert_alpha needs a display, so images loaded before set_mode are converted on their next use
+        if path not in self.converted and pygame.display.get_surface() is not None:
+            image = image.convert_alpha()
+            self.images[path] = image
+            self.converted.add(path)
+        return image
+
+    def preload(self, paths: [str]):
+        for path in paths:
+            self.get_image(path)
+
+    # serves the sprites packed by pack_assets.py from one atlas, false when there is no usable atlas
+    def load_atlas(self, directory: str):
+        if not os.path.exists(os.path.join(directory, ATLAS_INDEX)):
+            return False
+        try:
+            atlas = SpriteAtlas(directory)
+        except (OSError, ValueError, KeyError, pygame.error) as error:
+            self.game.handle_error(error)
+            return False
+        if atlas.is_stale():
+            print("{} is older than the sprites in it, run pack_assets.py".format(ATLAS_INDEX))
+            return False
+        # keys are relative to the directory pack_assets.py ran in, from elsewhere they name no sprite here
+        prefix = asset_key(directory) + "/"
+        if not any(path.startswith(prefix) for path in atlas.rects):
+            print("{} names no sprite in {}, run pack_assets.py from the game's directory".format(ATLAS_INDEX, directory))
+            return False
+        self.atlas = atlas
+        return True
+
+    def preload_async(self, directory: str, workers: int = 4):
+        paths = []
+        for root, _, names in os.walk(directory):
+            for name in sorted(names):
+                path = os.path.join(root, name).replace(os.sep, "/")
+                if name in (ATLAS_IMAGE, ATLAS_RAW) or (self.atlas is not None and asset_key(path) in self.atlas.rects):
+                    continue
+                if path.lower().endswith(IMAGE_EXTENSIONS) and path not in self.images and path not in self.pending:
+                    paths.append(path)
+        if not paths:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="assets")
+        if not self.pending:
+            self.preload_total = 0
+            self.preload_start = time.perf_counter()
+        self.preload_total += len(paths)
+        for path in paths:
+            self.pending[path] = self.executor.submit(pygame.image.load, path)
+
+    def poll(self):
+        for path, future in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[path]
+            try:
+                self.images[path] = future.result()
+            except (pygame.error, OSError) as error:
+                self.game.handle_error(error)
+                continue
+            if pygame.display.get_surface() is not None:
+                self.images[path] = self.images[path].convert_alpha()
+                self.converted.add(path)
+        if not self.pending:
+            self.preload_ms = (time.perf_counter() - self.preload_start) * 1000
+
+    # fraction of the current preload that is done
+    def progress(self):
+        if self.preload_total == 0:
+            return 1.0
+        return 1 - len(self.pending) / self.preload_total
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.pending = {}
+
+    def stats(self):
+        return {"images": len(self.images), "hits": self.hits, "misses": self.misses, "preload_ms": self.preload_ms}
+
+
+# SysFont lookups are done once per (name, size) and rendered text is kept in a bounded LRU cache,
+# so a label that doesn't change is only rasterized once
+class FontCache:
+    def __init__(self, max_surfaces: int = 256):
+        self.fonts = {}
+        self.surfaces = OrderedDict()
+        self.max_surfaces = max_surfaces
+        self.hits = 0
+        self.misses = 0
+
+    def get_font(self, name: str, size: int, bold: bool = False, italic: bool = False) -> pygame.font.Font:
+        key = (name, size, bold, italic)
+        font = self.fonts.get(key)
+        if font is None:
+            font = pygame.font.SysFont(name, size, bold, italic)
+            self.fonts[key] = font
+        return font
+
+    def render(self, font: pygame.font.Font, text: str, color: (int, int, int),
+               antialias: bool = True) -> pygame.Surface:
+        key = (font, text, tuple(color), antialias)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+        self.misses += 1
+        surface = font.render(text, antialias, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_surfaces:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def stats(self):
+        return {"fonts": len(self.fonts), "surfaces": len(self.surfaces), "hits": self.hits, "misses": self.misses}
+
+
+# pre-renders every sprite at a fixed number of angles the first time it's drawn rotated
+# draws snap to the nearest angle, sprites are evicted least recently used first once the budget is used up
+class RotationCache:
+    def __init__(self, steps: int = 72, budget: int = 32 * 1024 * 1024):
+        self.steps = steps
+        self.budget = budget
+        self.frames = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # sprites that can never fit the budget, they are rotated on every draw instead
+        self.oversized = weakref.WeakSet()
+        self.direct = 0
+
+    # bytes all rotations of img take, from the bounding boxes of the rotated rectangle, without rotating anything
+    def estimate(self, img: pygame.Surface) -> int:
+        width, height = img.get_size()
+        size = 0
+        for i in range(self.steps):
+            angle = math.radians(i * 360 / self.steps)
+            cos = abs(math.cos(angle))
+            sin = abs(math.sin(angle))
+            size += math.ceil(width * cos + height * sin) * math.ceil(width * sin + height * cos)
+        return size * img.get_bytesize()
+
+    def build(self, img: pygame.Surface):
+        step = 360 / self.steps
+        frames = [pygame.transform.rotate(img, i * step) for i in range(self.steps)]
+        size = sum(frame.get_width() * frame.get_height() * frame.get_bytesize() for frame in frames)
+        return frames, size
+
+    def get(self, img: pygame.Surface, angle: float) -> pygame.Surface:
+        frames = self.frames.get(img)
+        if frames is None:
+            if img in self.oversized or self.estimate(img) > self.budget:
+                self.oversized.add(img)
+                self.direct += 1
+                return pygame.transform.rotate(img, angle)
+            self.misses += 1
+            frames, size = self.build(img)
+            while self.bytes + size > self.budget:
+                old, _ = self.frames.popitem(last=False)
+                self.bytes -= self.sizes.pop(old)
+            self.frames[img] = frames
+            self.sizes[img] = size
+            self.bytes += size
+        else:
+            self.hits += 1
+            self.frames.move_to_end(img)
+        return frames[round(angle * self.steps / 360) % self.steps]
+
+    def stats(self):
+        return {"sprites": len(self.frames), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                "oversized": len(self.oversized), "direct": self.direct}
+
+
+# keeps released objects around for reuse, objects need a reset method taking the acquire arguments
+class Pool:
+    def __init__(self, factory, capacity: int = 0):
+        self.factory = factory
+        self.free = [factory() for _ in range(capacity)]
+        self.capacity = capacity
+        self.created = capacity
+        self.acquired = 0
+        self.released = 0
+        self.peak = 0
+
+    def acquire(self, *args):
+        if self.free:
+            obj = self.free.pop()
+        else:
+            obj = self.factory()
+            self.created += 1
+        obj.reset(*args)
+        self.acquired += 1
+        in_use = self.acquired - self.released
+        if in_use > self.peak:
+            self.peak = in_use
+        return obj
+
+    def release(self, obj):
+        self.free.append(obj)
+        self.released += 1
+
+    def stats(self):
+        return {"capacity": self.capacity, "created": self.created, "free": len(self.free),
+                "in_use": self.acquired - self.released, "peak": self.peak, "acquired": self.acquired,
+                "released": self.released}
+
+
+# a formula from a wave file, parsed once at load and evaluated by walking its syntax tree, so a wave file can't
+# run code: only numbers, the given names, + - * / // %, comparisons, and/or/not and "a if condition else b"
+class WaveFormula:
+    BINARY = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+              ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod}
+    UNARY = {ast.UAdd: operator.pos, ast.USub: operator.neg, ast.Not: operator.not_}
+    COMPARE = {ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+               ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+    def __init__(self, text: str, names):
+        self.text = text
+        self.tree = ast.parse(text, mode="eval").body
+        self.check(self.tree, names)
+
+    def check(self, node, names):
+        if isinstance(node, ast.Constant):
+            if type(node.value) not in (int, float, bool):
+                raise ValueError("{!r} isn't a number".format(node.value))
+        elif isinstance(node, ast.Name):
+            if node.id not in names:
+                raise ValueError("unknown name {}, formulas can use {}".format(node.id, ", ".join(sorted(names))))
+        elif isinstance(node, ast.BinOp) and type(node.op) in self.BINARY:
+            self.check(node.left, names)
+            self.check(node.right, names)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in self.UNARY:
+            self.check(node.operand, names)
+        elif isinstance(node, ast.Compare) and all(type(op) in self.COMPARE for op in node.ops):
+            for child in [node.left] + node.comparators:
+                self.check(child, names)
+        elif isinstance(node, ast.BoolOp):
+            for child in node.values:
+                self.check(child, names)
+        elif isinstance(node, ast.IfExp):
+            for child in (node.test, node.body, node.orelse):
+                self.check(child, names)
+        else:
+            raise ValueError("{} isn't allowed in formulas".format(type(getattr(node, "op", node)).__name__))
+
+    def evaluate(self, names: dict):
+        return self.evaluate_node(self.tree, names)
+
+    def evaluate_node(self, node, names: dict):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            return names[node.id]
+        if isinstance(node, ast.BinOp):
+            return self.BINARY[type(node.op)](self.evaluate_node(node.left, names),
+                                              self.evaluate_node(node.right, names))
+        if isinstance(node, ast.UnaryOp):
+            return self.UNARY[type(node.op)](self.evaluate_node(node.operand, names))
+        if isinstance(node, ast.Compare):
+            left = self.evaluate_node(node.left, names)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self.evaluate_node(comparator, names)
+                if not self.COMPARE[type(op)](left, right):
+                    return False
+                left = right
+            return True
+        if isinstance(node, ast.BoolOp):
+            # short circuits and returns the deciding value, like python's and/or
+            value = None
+            for child in node.values:
+                value = self.evaluate_node(child, names)
+                if isinstance(node.op, ast.And) != bool(value):
+                    return value
+            return value
+        if self.evaluate_node(node.test, names):
+            return self.evaluate_node(node.body, names)
+        return self.evaluate_node(node.orelse, names)
+
+
+# names the x and y formulas of a spawn entry can use
+WAVE_NAMES = ("width", "height", "i", "count", "n")
+# screen size the formulas are tried out with at load, so broken ones are reported then and not in the middle of a game
+WAVE_SAMPLE_RESOLUTION = (800, 600)
+# repetitions of an entry with times set that are tried out at load, the runner reports and skips any later one that fails
+WAVE_SAMPLE_TIMES = 1000
+
+
+# an integer field of a wave file, missing fields take the default or are an error when there is none
+def wave_integer(path: str, data: dict, key: str, default=None, minimum: int = None):
+    if key not in data:
+        if default is None:
+            raise ValueError("{}: {} is missing".format(path, key))
+        return default
+    value = data[key]
+    if type(value) is not int:
+        raise ValueError("{}: {} has to be a whole number, not {!r}".format(path, key, value))
+    if minimum is not None and value < minimum:
+        raise ValueError("{}: {} has to be at least {}".format(path, key, minimum))
+    return value
+
+
+# one spawn entry of a wave file, enemy is one of the names in enemies
+# x and y are numbers or WaveFormulas using width, height, i (index within count), count and n (how many times the
+# entry repeated so far)
+class WaveSpawn:
+    def __init__(self, path: str, entry: dict, enemies):
+        if not isinstance(entry, dict):
+            raise ValueError("{}: spawn entries have to be objects".format(path))
+        self.tick = wave_integer(path, entry, "tick", minimum=0)
+        self.enemy = entry.get("enemy")
+        if self.enemy not in enemies:
+            raise ValueError("{}: unknown enemy {!r}, known are {}".format(path, self.enemy, ", ".join(enemies)))
+        self.count = wave_integer(path, entry, "count", 1, 1)
+        self.every = wave_integer(path, entry, "every", 0, 1) or None
+        self.times = wave_integer(path, entry, "times", 0, 1) or None
+        try:
+            self.x = WaveFormula(str(entry["x"]), WAVE_NAMES)
+            self.y = WaveFormula(str(entry["y"]), WAVE_NAMES)
+        except KeyError as error:
+            raise ValueError("{}: spawn entry is missing {}".format(path, error))
+        except (SyntaxError, ValueError) as error:
+            raise ValueError("{}: {}".format(path, error))
+        try:
+            for n in range(min(self.times or 1, WAVE_SAMPLE_TIMES)):
+                self.positions(n, WAVE_SAMPLE_RESOLUTION)
+        except (ArithmeticError, TypeError, ValueError) as error:
+            raise ValueError("{}: x = {}, y = {}: {}".format(path, self.x.text, self.y.text, error))
+
+    # all positions of the n-th repetition, raises when a formula doesn't give a number
+    def positions(self, n: int, resolution: (int, int)) -> list:
+        names = {"width": resolution[0], "height": resolution[1], "count": self.count, "n": n}
+        positions = []
+        for i in range(self.count):
+            names["i"] = i
+            x, y = self.x.evaluate(names), self.y.evaluate(names)
+            if type(x) not in (int, float) or type(y) not in (int, float):
+                raise ValueError("position {!r}, {!r} isn't a pair of numbers".format(x, y))
+            positions.append((x, y))
+        return positions
+
+
+# a wave file, when duration is set the wave named by next takes over once that many ticks passed
+# data is read from path unless given
+class WaveScript:
+    def __init__(self, path: str, enemies, data: dict = None):
+        if data is None:
+            with open(path, "r") as file:
+                data = json.load(file)
+        if not isinstance(data, dict) or not isinstance(data.get("spawns"), list):
+            raise ValueError("{}: a wave file is an object with a list of spawns".format(path))
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.duration = wave_integer(path, data, "duration", 0, 1) or None
+        self.next = data.get("next")
+        if self.next is not None and not isinstance(self.next, str):
+            raise ValueError("{}: next has to be the name of a wave".format(path))
+        self.spawns = [WaveSpawn(path, entry, enemies) for entry in data["spawns"]]
+
+
+# every wave file in a directory, enemies are the enemy names spawn entries can use
+# files are checked completely when loading, a broken file is reported and only that wave keeps its previous version,
+# or is left out when it never loaded; so are waves whose next wave is missing
+class WaveLibrary:
+    def __init__(self, game, directory: str, enemies):
+        self.game = game
+        self.directory = directory
+        self.enemies = list(enemies)
+        self.scripts = {}
+        self.reload()
+
+    # returns whether every file loaded
+    def reload(self):
+        try:
+            names = sorted(name for name in os.listdir(self.directory) if name.endswith(".json"))
+        except OSError as error:
+            self.game.handle_error(error)
+            return False
+        scripts = {}
+        complete = True
+        for name in names:
+            try:
+                script = WaveScript(os.path.join(self.directory, name), self.enemies)
+            except (OSError, ValueError, SyntaxError) as error:
+                self.game.handle_error(error)
+                complete = False
+                previous = self.scripts.get(os.path.splitext(name)[0])
+                if previous is not None:
+                    scripts[previous.name] = previous
+                continue
+            scripts[script.name] = script
+        # dropping a wave can leave another one pointing at nothing, so this goes on until nothing changes
+        missing = True
+        while missing:
+            missing = [script for script in scripts.values() if script.next is not None and script.next not in scripts]
+            for script in missing:
+                self.game.handle_error(ValueError("{}: next wave {} doesn't exist".format(script.path, script.next)))
+                complete = False
+                del scripts[script.name]
+        self.scripts = scripts
+        return complete
+
+    # a wave that isn't there is reported and played as an empty one
+    def get(self, name: str):
+        script = self.scripts.get(name)
+        if script is None:
+            self.game.handle_error(LookupError("no wave named {} in {}".format(name, self.directory)))
+            script = WaveScript(os.path.join(self.directory, name + ".json"), self.enemies, {"spawns": []})
+        return script
+
+
+# plays a WaveScript, spawns are kept in a heap ordered by tick so an update only looks at the ones that are due
+# entries due on the same tick fire in file order, a spawn whose formulas fail is reported and skipped
+class WaveRunner:
+    def __init__(self, script: WaveScript, spawn, resolution: (int, int), handle_error=print):
+        self.script = script
+        self.spawn = spawn
+        self.resolution = resolution
+        self.handle_error = handle_error
+        self.timer = 0
+        self.queue = [(entry.tick, order, 0) for order, entry in enumerate(script.spawns)]
+        heapq.heapify(self.queue)
+        self.fire_due()
+
+    @property
+    def finished(self):
+        return self.script.duration is not None and self.timer >= self.script.duration
+
+    def update(self):
+        self.timer += 1
+        self.fire_due()
+
+    def fire_due(self):
+        queue = self.queue
+        while queue and queue[0][0] <= self.timer:
+            tick, order, n = heapq.heappop(queue)
+            entry = self.script.spawns[order]
+            try:
+                positions = entry.positions(n, self.resolution)
+            except (ArithmeticError, TypeError, ValueError) as error:
+                self.handle_error(ValueError("{}: x = {}, y = {}, n = {}: {}".format(
+                    self.script.path, entry.x.text, entry.y.text, n, error)))
+                positions = ()
+            for x, y in positions:
+                self.spawn(entry.enemy, x, y)
+            if entry.every is not None and (entry.times is None or n + 1 < entry.times):
+                heapq.heappush(queue, (tick + entry.every, order, n + 1))
+
+
+class TimerScope:
+    def __init__(self, timer, name: str):
+        self.timer = timer
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class NullScope:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+# accumulates wall time per named phase, does nothing until enabled
+# also keeps a short per-frame history for the overlay and can record a chrome://tracing compatible trace
+class FrameTimer:
+    null_scope = NullScope()
+
+    def __init__(self, history: int = 120):
+        self.enabled = False
+        self.totals = {}
+        self.counts = {}
+        self.maxima = {}
+        self.frame = {}
+        self.frames = deque(maxlen=history)
+        self.frame_start = time.perf_counter()
+        self.blocks = sys.getallocatedblocks()
+        self.collections = self.gc_collections()
+        self.tracing = False
+        self.trace_start = 0
+        self.events = []
+
+    def scope(self, name: str):
+        if not self.enabled:
+            return self.null_scope
+        return TimerScope(self, name)
+
+    def record(self, name: str, start: float, end: float):
+        seconds = end - start
+        self.totals[name] = self.totals.get(name, 0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if seconds > self.maxima.get(name, 0):
+            self.maxima[name] = seconds
+        self.frame[name] = self.frame.get(name, 0) + seconds
+        if self.tracing:
+            self.events.append({"name": name, "ph": "X", "ts": (start - self.trace_start) * 1000000,
+                                "dur": seconds * 1000000, "pid": 0, "tid": 0})
+
+    @staticmethod
+    def gc_collections():
+        return sum(generation["collections"] for generation in gc.get_stats())
+
+    # closes the current frame, counts are whatever the state wants to show (entities, particles, ...)
+    def end_frame(self, counts: dict):
+        now = time.perf_counter()
+        blocks = sys.getallocatedblocks()
+        collections = self.gc_collections()
+        frame = {"ms": (now - self.frame_start) * 1000, "scopes": self.frame, "counts": counts,
+                 "allocated_blocks": blocks - self.blocks, "gc_collections": collections - self.collections}
+        self.frames.append(frame)
+        if self.tracing:
+            args = dict(counts)
+            args["allocated_blocks"] = frame["allocated_blocks"]
+            self.events.append({"name": "counts", "ph": "C", "ts": (now - self.trace_start) * 1000000, "pid": 0,
+                                "args": args})
+            if frame["gc_collections"]:
+                self.events.append({"name": "gc", "ph": "i", "s": "t", "ts": (now - self.trace_start) * 1000000,
+                                    "pid": 0, "tid": 0, "args": {"collections": frame["gc_collections"]}})
+        self.frame = {}
+        self.frame_start = now
+        self.blocks = blocks
+        self.collections = collections
+
+    # mean of every scope over the frames in the history
+    def frame_averages(self):
+        if not self.frames:
+            return {}
+        averages = {}
+        for frame in self.frames:
+            for name, seconds in frame["scopes"].items():
+                averages[name] = averages.get(name, 0) + seconds * 1000
+        return {name: total / len(self.frames) for name, total in averages.items()}
+
+    def start_trace(self):
+        self.enabled = True
+        self.tracing = True
+        self.trace_start = time.perf_counter()
+        self.events = []
+
+    def stop_trace(self, path: str):
+        self.tracing = False
+        with open(path, "w") as file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, file)
+        self.events = []
+
+    def reset(self):
+        self.totals = {}
+        self.counts = {}
+        self.maxima = {}
+        self.frames.clear()
+
+    def results(self):
+        return {name: {"calls": self.counts[name],
+                       "total_ms": self.totals[name] * 1000,
+                       "mean_ms": self.totals[name] * 1000 / self.counts[name],
+                       "max_ms": self.maxima[name] * 1000} for name in self.totals}
+
+
+# F3 shows frame timings, per scope averages, entity counts and allocations on top of the game
+class ProfilerOverlay:
+    def __init__(self, game):
+        self.game = game
+        self.visible = False
+        self.font = None
+
+    def toggle(self):
+        self.visible = not self.visible
+        # a running trace still needs the timer
+        self.game.timer.enabled = self.visible or self.game.timer.tracing
+
+    def lines(self):
+        timer = self.game.timer
+        if not timer.frames:
+            return ["profiling..."]
+        last = timer.frames[-1]
+        mean_ms = sum(frame["ms"] for frame in timer.frames) / len(timer.frames)
+        worst_ms = max(frame["ms"] for frame in timer.frames)
+        lines = ["frame {:6.2f} ms  avg {:6.2f}  worst {:6.2f}".format(last["ms"], mean_ms, worst_ms)]
+        averages = timer.frame_averages()
+        for name in sorted(averages, key=averages.get, reverse=True)[:12]:
+            lines.append("{:<28} {:6.3f} ms".format(name, averages[name]))
+        lines.append(" ".join("{}={}".format(name, count) for name, count in last["counts"].items()))
+        lines.append("allocated blocks {:+d}  gc {}".format(last["allocated_blocks"], last["gc_collections"]))
+        return lines
+
+    def draw(self):
+        if self.font is None:
+            self.font = self.game.fonts.get_font("monospace", 14)
+        # this text changes every frame, so it's rendered directly instead of going through the text cache
+        surfaces = [self.font.render(line, True, (255, 255, 0)) for line in self.lines()]
+        width = max(surface.get_width() for surface in surfaces) + 10
+        height = sum(surface.get_height() for surface in surfaces) + 10
+        background = pygame.Surface((width, height), pygame.SRCALPHA)
+        background.fill((0, 0, 0, 180))
+        self.game.renderer.draw_img(background, Vector2(0, 0))
+        y = 5
+        for surface in surfaces:
+            self.game.renderer.draw_img(surface, Vector2(5, y))
+            y += surface.get_height()
+
+
+# streams drawn frames to disk from a writer thread
+# raw writes packed rgb24 frames back to back into one file (ffmpeg -f rawvideo -pix_fmt rgb24 -s WxH -i path),
+# png writes one image per frame, path being a pattern like "frames/%05d.png"
+# the main thread only copies the surface's pixel buffer into one of queue_size preallocated buffers, the writer
+# thread converts it to rgb; when no buffer is free the frame is dropped so capturing never stalls the game loop,
+# unless wait is set for offline runs like headless replays where every frame should end up in the video
+class FrameCapture:
+    def __init__(self, path: str, surface: pygame.Surface, capture_format: str = "raw", queue_size: int = 8,
+                 wait: bool = False):
+        if capture_format not in ("raw", "png"):
+            raise ValueError("unknown capture format: {}".format(capture_format))
+        if surface.get_bytesize() != 4:
+            raise ValueError("frame capture needs a 32 bit surface")
+        if capture_format == "png":
+            # checked up front, the writer thread would only find out on the first frame
+            try:
+                first = path % 0
+            except (TypeError, ValueError):
+                first = None
+            if first is None or first == path % 1:
+                raise ValueError("png capture needs a path with a frame number placeholder like %05d: {}".format(path))
+            directory = os.path.dirname(first)
+            if directory and not os.path.isdir(directory):
+                raise FileNotFoundError("capture directory doesn't exist: {}".format(directory))
+        self.path = path
+        self.size = surface.get_size()
+        self.pitch = surface.get_pitch()
+        shifts = surface.get_shifts()[:3]
+        self.channels = [shift // 8 if sys.byteorder == "little" else 3 - shift // 8 for shift in shifts]
+        self.format = capture_format
+        self.wait = wait
+        self.written = 0
+        self.dropped = 0
+        self.frame = 0
+        # set by the writer thread when it fails, no frames are taken after that
+        self.error = None
+        self.free = queue.Queue()
+        for _ in range(queue_size):
+            self.free.put(numpy.empty((self.size[1], self.pitch), dtype=numpy.uint8))
+        self.frames = queue.Queue()
+        self.file = open(path, "wb") if capture_format == "raw" else None
+        self.thread = threading.Thread(target=self.write_frames, name="capture", daemon=True)
+        self.thread.start()
+
+    def capture(self, surface: pygame.Surface):
+        index = self.frame
+        self.frame += 1
+        if surface.get_size() != self.size or surface.get_pitch() != self.pitch:
+            self.dropped += 1
+            return
+        buffer = None
+        while buffer is None:
+            if self.error is not None:
+                raise RuntimeError("frame capture failed: {}".format(self.error)) from self.error
+            # waiting wakes up now and then to notice a writer that died
+            try:
+                buffer = self.free.get(self.wait, 0.1)
+            except queue.Empty:
+                if not self.wait:
+                    self.dropped += 1
+                    return
+        view = surface.get_view("1")
+        numpy.copyto(buffer, numpy.frombuffer(view, numpy.uint8).reshape(buffer.shape))
+        del view
+        self.frames.put((index, buffer))
+
+    def write_frames(self):
+        width, height = self.size
+        while True:
+            item = self.frames.get()
+            if item is None:
+                return
+            index, buffer = item
+            try:
+                try:
+                    rgb = numpy.ascontiguousarray(
+                        buffer.reshape(height, self.pitch // 4, 4)[:, :width, self.channels])
+                finally:
+                    self.free.put(buffer)
+                if self.file is not None:
+                    self.file.write(memoryview(rgb))
+                else:
+                    pygame.image.save(pygame.image.frombuffer(rgb, self.size, "RGB"), self.path % index)
+            except Exception as e:
+                self.error = e
+                return
+            self.written += 1
+
+    def close(self):
+        self.frames.put(None)
+        self.thread.join()
+        if self.file is not None:
+            self.file.close()
+
+
 # utilities
 
+# in-place operators mutate the vector, use copy() when a vector has to be shared
 class Vector2:
+    __slots__ = ("x", "y")
+
     def __init__(self, x: float, y: float):
         self.x = x
         self.y = y
@@ -236,37 +1630,53 @@ class Vector2:
         return Vector2(self.x + other.x, self.y + other.y)
 
     def __iadd__(self, other):
-        self = self + other
+        self.x += other.x
+        self.y += other.y
         return self
 
     def __sub__(self, other):
         return Vector2(self.x - other.x, self.y - other.y)
 
     def __isub__(self, other):
-        self = self - other
+        self.x -= other.x
+        self.y -= other.y
         return self
 
     def __mul__(self, other):
         return Vector2(self.x * other, self.y * other)
 
     def __imul__(self, other):
-        self = self * other
+        self.x *= other
+        self.y *= other
         return self
 
     def __truediv__(self, other):
         return Vector2(self.x / other, self.y / other)
 
     def __itruediv__(self, other):
-        self = self / other
+        self.x /= other
+        self.y /= other
         return self
 
     def __floordiv__(self, other):
         return Vector2(self.x // other, self.y // other)
 
     def __ifloordiv__(self, other):
-        self = self // other
+        self.x //= other
+        self.y //= other
+        return self
+
+    def copy(self):
+        return Vector2(self.x, self.y)
+
+    def set(self, x: float, y: float):
+        self.x = x
+        self.y = y
         return self
 
+    def lerp(self, other, t: float):
+        return Vector2(self.x + (other.x - self.x) * t, self.y + (other.y - self.y) * t)
+
     def __str__(self):
         return "Vector2({}, {})".format(self.x, self.y)
 
@@ -300,6 +1710,8 @@ class Vector2:
 
 
 class Rectangle:
+    __slots__ = ("pos", "size")
+
     def __init__(self, pos: Vector2, size: Vector2):
         self.pos = pos
         self.size = size
@@ -328,6 +1740,18 @@ class Rectangle:
     def center_on(self, other):
         self.pos = other.center() - self.size / 2
 
+    # moves the rectangle without allocating, unlike set_pos these never replace pos
+    def move_to(self, x: float, y: float):
+        self.pos.x = x
+        self.pos.y = y
+
+    def center_at(self, x: float, y: float):
+        self.pos.x = x - self.size.x / 2
+        self.pos.y = y - self.size.y / 2
+
+    def copy(self):
+        return Rectangle(self.pos.copy(), self.size.copy())
+
     def top_left(self):
         return self.pos
 
@@ -379,8 +1803,48 @@ class Rectangle:
     def intersects(self, other):
         return self.pos.x < other.pos.x + other.size.x and self.pos.x + self.size.x > other.pos.x and self.pos.y < other.pos.y + other.size.y and self.pos.y + self.size.y > other.pos.y
 
+    # ray against box: the fractions (entry, exit) of move during which this rectangle, moving along move, intersects
+    # other, or None when it doesn't anywhere along the way; entry is the time of impact, 0 if they already intersect
+    def sweep(self, move, other):
+        entry = 0.0
+        exit = 1.0
+        axes = ((self.pos.x, self.size.x, move.x, other.pos.x, other.size.x),
+                (self.pos.y, self.size.y, move.y, other.pos.y, other.size.y))
+        for start, size, delta, other_start, other_size in axes:
+            # on this axis they intersect while low < delta * t < high
+            low = other_start - start - size
+            high = other_start + other_size - start
+            if delta == 0:
+                if low >= 0 or high <= 0:
+                    return None
+                continue
+            near = low / delta
+            far = high / delta
+            if near > far:
+                near, far = far, near
+            if near > entry:
+                entry = near
+            if far < exit:
+                exit = far
+            if entry >= exit:
+                return None
+        return entry, exit
+
+    # the box covering this rectangle along the whole of move, for broad phase queries
+    # written into out instead of allocating a new rectangle when given
+    def swept(self, move, out=None):
+        if out is None:
+            out = Rectangle(Vector2(0, 0), Vector2(0, 0))
+        out.pos.x = self.pos.x + min(move.x, 0)
+        out.pos.y = self.pos.y + min(move.y, 0)
+        out.size.x = self.size.x + abs(move.x)
+        out.size.y = self.size.y + abs(move.y)
+        return out
+
 
 class Circle:
+    __slots__ = ("pos", "radius")
+
     def __init__(self, pos: Vector2, radius: float):
         self.pos = pos
         self.radius = radius
@@ -409,6 +1873,13 @@ class Circle:
     def center_on(self, other):
         self.pos = other.center()
 
+    def center_at(self, x: float, y: float):
+        self.pos.x = x
+        self.pos.y = y
+
+    def copy(self):
+        return Circle(self.pos.copy(), self.radius)
+
     def top_left(self):
         return Vector2(self.pos.x - self.radius, self.pos.y - self.radius)
 
@@ -458,49 +1929,475 @@ class Circle:
         self.pos.y = y
 
 
+# stand-in handed to on_hit callbacks for a bullet stored in a BulletField
+class FieldBullet:
+    def __init__(self, center: Vector2, velocity: Vector2, friendly: bool):
+        self.center = center
+        self.velocity = velocity
+        self.friendly = friendly
+        self.dead = False
+
+
+# all bullets of one kind stored as numpy arrays, moved, culled and hit tested in a few array operations per tick
+class BulletField:
+    def __init__(self, state, size: Vector2, color: (int, int, int), friendly: bool = False, capacity: int = 256,
+                 layer: int = None):
+        self.state = state
+        self.game = state.game
+        self.size = size
+        self.color = color
+        self.friendly = friendly
+        # bullets are queued on this render layer, or drawn right away when it is None
+        self.layer = layer
+        self.count = 0
+        self.positions = numpy.zeros((capacity, 2))
+        self.previous = numpy.zeros((capacity, 2))
+        self.velocities = numpy.zeros((capacity, 2))
+
+    def __len__(self):
+        return self.count
+
+    def spawn(self, x: float, y: float, vx: float, vy: float):
+        if self.count == len(self.positions):
+            capacity = len(self.positions) * 2
+            for name in ("positions", "previous", "velocities"):
+                new = numpy.zeros((capacity, 2))
+                new[:self.count] = getattr(self, name)[:self.count]
+                setattr(self, name, new)
+        self.positions[self.count] = (x, y)
+        self.previous[self.count] = (x, y)
+        self.velocities[self.count] = (vx, vy)
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def keep(self, mask):
+        keep = numpy.flatnonzero(mask)
+        k = len(keep)
+        self.positions[:k] = self.positions[keep]
+        self.previous[:k] = self.previous[keep]
+        self.velocities[:k] = self.velocities[keep]
+        self.count = k
+
+    # moves every bullet and drops the ones that left the screen
+    def update(self):
+        n = self.count
+        if n == 0:
+            return
+        positions = self.positions[:n]
+        self.previous[:n] = positions
+        positions += self.velocities[:n]
+        half_x = self.size.x / 2
+        half_y = self.size.y / 2
+        x = positions[:, 0]
+        y = positions[:, 1]
+        inside = (y <= self.game.resolution[1] + half_y) & (y >= -half_y) & \
+                 (x <= self.game.resolution[0] + half_x) & (x >= -half_x)
+        if not inside.all():
+            self.keep(inside)
+
+    # indices of the bullets whose box intersects rect, same test as Rectangle.intersects
+    def overlapping(self, rect: Rectangle):
+        n = self.count
+        if n == 0:
+            return ()
+        x = self.positions[:n, 0] - self.size.x / 2
+        y = self.positions[:n, 1] - self.size.y / 2
+        hits = (x < rect.pos.x + rect.size.x) & (x + self.size.x > rect.pos.x) & \
+               (y < rect.pos.y + rect.size.y) & (y + self.size.y > rect.pos.y)
+        return numpy.flatnonzero(hits)
+
+    # the sprite the bullets are drawn with
+    @property
+    def sprite(self) -> pygame.Surface:
+        return self.game.renderer.circle_sprite(int(self.size.x / 2), self.color)
+
+    # Rectangle.sweep for every bullet's box moving from its previous to its current position, relative to rect
+    # which moved by motion during the same tick
+    # returns the indices of the bullets that pass through rect ordered by time of impact, bullets hitting at the
+    # same time in spawn order, and their entry and exit times
+    def sweeping(self, rect: Rectangle, motion: Vector2 = None):
+        n = self.count
+        if n == 0:
+            return (), (), ()
+        start = self.previous[:n]
+        move = self.positions[:n] - start
+        rect_x, rect_y = rect.pos.x, rect.pos.y
+        if motion is not None:
+            move -= (motion.x, motion.y)
+            rect_x -= motion.x
+            rect_y -= motion.y
+        entry = numpy.zeros(n)
+        exit = numpy.ones(n)
+        for axis, rect_start, rect_size, size in ((0, rect_x, rect.size.x, self.size.x),
+                                                  (1, rect_y, rect.size.y, self.size.y)):
+            low = rect_start - (start[:, axis] + size / 2)
+            high = rect_start + rect_size - (start[:, axis] - size / 2)
+            delta = move[:, axis]
+            still = delta == 0
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                t0 = low / delta
+                t1 = high / delta
+            # a bullet not moving on this axis either always or never intersects on it
+            inside = (low < 0) & (high > 0)
+            near = numpy.where(still, numpy.where(inside, -numpy.inf, numpy.inf), numpy.minimum(t0, t1))
+            far = numpy.where(still, numpy.where(inside, numpy.inf, -numpy.inf), numpy.maximum(t0, t1))
+            numpy.maximum(entry, near, out=entry)
+            numpy.minimum(exit, far, out=exit)
+        indices = numpy.flatnonzero(entry < exit)
+        indices = indices[numpy.argsort(entry[indices], kind="stable")]
+        return indices, entry[indices], exit[indices]
+
+    # calls on_hit for every bullet that passed through rect this tick, in the order they hit it
+    # bullets the callback marks as dead are removed, just like with regular projectiles
+    # with img given, rect only picks the candidates and a bullet has to overlap img drawn centered at center pixel
+    # for pixel somewhere along its way; rect, img and center moved by motion this tick
+    def hit_test(self, rect: Rectangle, on_hit, img: pygame.Surface = None, center: Vector2 = None,
+                 motion: Vector2 = None):
+        indices, entries, exits = self.sweeping(rect, motion)
+        if len(indices) == 0:
+            return
+        alive = numpy.ones(self.count, dtype=bool)
+        for i, entry, exit in zip(indices.tolist(), entries.tolist(), exits.tolist()):
+            bullet = FieldBullet(Vector2(*self.positions[i].tolist()), Vector2(*self.velocities[i].tolist()),
+                                 self.friendly)
+            if img is not None:
+                start = Vector2(*self.previous[i].tolist())
+                move = bullet.center - start
+                center_start = center
+                if motion is not None:
+                    move -= motion
+                    center_start = center - motion
+                if not self.game.masks.overlap_along(self.sprite, start, move, entry, exit, img, center_start):
+                    continue
+            on_hit(bullet)
+            if bullet.dead:
+                alive[i] = False
+        if not alive.all():
+            self.keep(alive)
+
+    def draw(self):
+        n = self.count
+        if n == 0:
+            return
+        radius = int(self.size.x / 2)
+        positions = interpolate(self.previous[:n], self.positions[:n], self.game.alpha).astype(int)
+        if self.layer is None:
+            self.game.renderer.draw_circles(positions.tolist(), [radius] * n, [self.color] * n)
+        else:
+            self.game.renderer.queue_imgs(self.sprite, [tuple(pos) for pos in (positions - radius).tolist()],
+                                          self.layer)
+
+
+# uniform grid broadphase, objects are bucketed by the cells their rectangle covers
+# query returns candidates in insertion order so results match a brute force loop over the same list
+class SpatialHash:
+    def __init__(self, cell_size: float = 128):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.count = 0
+
+    def clear(self):
+        self.cells.clear()
+        self.count = 0
+
+    def cell_range(self, rect: Rectangle):
+        return (int(rect.pos.x // self.cell_size), int(rect.pos.y // self.cell_size),
+                int((rect.pos.x + rect.size.x) // self.cell_size), int((rect.pos.y + rect.size.y) // self.cell_size))
+
+    def insert(self, obj, rect: Rectangle):
+        entry = (self.count, obj)
+        self.count += 1
+        x0, y0, x1, y1 = self.cell_range(rect)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                bucket = self.cells.get((x, y))
+                if bucket is None:
+                    self.cells[(x, y)] = [entry]
+                else:
+                    bucket.append(entry)
+
+    def query(self, rect: Rectangle):
+        x0, y0, x1, y1 = self.cell_range(rect)
+        if x0 == x1 and y0 == y1:
+            return [obj for _, obj in self.cells.get((x0, y0), ())]
+        found = {}
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                for index, obj in self.cells.get((x, y), ()):
+                    found[index] = obj
+        return [found[index] for index in sorted(found)]
+
+
+# pygame.mask bitmasks of sprites for pixel precise collisions, built the first time a sprite is tested
+# meant as the narrow phase after a rectangle test, so only pairs whose boxes overlap pay for it
+class MaskCache:
+    def __init__(self):
+        self.masks = {}
+        self.tests = 0
+        self.overlaps = 0
+
+    def get(self, img: pygame.Surface) -> pygame.mask.Mask:
+        mask = self.masks.get(img)
+        if mask is None:
+            mask = pygame.mask.from_surface(img)
+            self.masks[img] = mask
+        return mask
+
+    # the sprites are placed by their centers, the same way draw_img_centered and queue_img_centered place them
+    def overlap(self, img_a: pygame.Surface, center_a: Vector2, img_b: pygame.Surface, center_b: Vector2) -> bool:
+        self.tests += 1
+        offset = (int(center_b.x - img_b.get_width() / 2) - int(center_a.x - img_a.get_width() / 2),
+                  int(center_b.y - img_b.get_height() / 2) - int(center_a.y - img_a.get_height() / 2))
+        if self.get(img_a).overlap(self.get(img_b), offset) is None:
+            return False
+        self.overlaps += 1
+        return True
+
+    # img_a moving from start along move, tested between the entry and exit fractions of the move, e.g. the ones
+    # Rectangle.sweep gave for the pair's boxes, in steps no longer than half of img_a's shorter side
+    def overlap_along(self, img_a: pygame.Surface, start: Vector2, move: Vector2, entry: float, exit: float,
+                      img_b: pygame.Surface, center_b: Vector2) -> bool:
+        step = max(min(img_a.get_size()) / 2, 1)
+        steps = max(math.ceil(math.hypot(move.x, move.y) * (exit - entry) / step), 1)
+        center = Vector2(0, 0)
+        for i in range(steps + 1):
+            t = entry + (exit - entry) * i / steps
+            center.set(start.x + move.x * t, start.y + move.y * t)
+            if self.overlap(img_a, center, img_b, center_b):
+                return True
+        return False
+
+    def stats(self):
+        return {"sprites": len(self.masks), "tests": self.tests, "overlaps": self.overlaps}
+
+
+# tracks which parts of the screen were drawn to, for Game.present in dirty rect mode
+# fill restores last frame's rects from a cached background instead of clearing the whole screen
+class DirtyRects:
+    def __init__(self, game, max_rects: int = 64):
+        self.game = game
+        self.max_rects = max_rects
+        self.current = []
+        self.previous = []
+        self.background = None
+        self.background_color = None
+        self.full = True
+
+    # the next frame is pushed to the display as a whole
+    def invalidate(self):
+        self.full = True
+
+    def add(self, rect: pygame.Rect):
+        self.current.append(rect)
+
+    def restore(self, color: (int, int, int)):
+        screen = self.game.screen
+        if self.background is None or self.background_color != color \
+                or self.background.get_size() != screen.get_size():
+            self.background = pygame.Surface(screen.get_size()).convert()
+            self.background.fill(color)
+            self.background_color = color
+            self.full = True
+        if self.full:
+            screen.blit(self.background, (0, 0))
+        else:
+            for rect in self.previous:
+                screen.blit(self.background, rect, rect)
+
+    # this frame's rects plus last frame's, since whatever was drawn there has been erased
+    def collect(self):
+        if self.full:
+            rects = [self.game.screen.get_rect()]
+        else:
+            rects = self.previous + self.current
+            # past a point one bounding rect is cheaper for SDL than many small ones
+            if len(rects) > self.max_rects:
+                rects = [rects[0].unionall(rects)]
+        # after a full frame anything may have been drawn anywhere, so the next restore erases the whole screen
+        self.previous = [self.game.screen.get_rect()] if self.full else self.current
+        self.current = []
+        self.full = False
+        return rects
+
+
+# draw_* methods draw right away, queue_* methods collect sprites until flush, which blits them in bulk
+# sorted by layer and then by texture, anything drawn right away after a flush ends up on top of the queue
+# draws to the screen unless set_target pointed it at an offscreen surface, dirty rects only apply to the screen
 class Renderer:
     def __init__(self, game):
         self.game = game
+        self.offscreen = None
+        self.queue = []
+        self.circle_sprites = {}
+        # sort keys of the textures in the order they were first queued, unlike id() the same in every run, so
+        # sprites of different textures overlap the same way every time
+        self.texture_keys = weakref.WeakKeyDictionary()
+        self.textures_seen = 0
+
+    @property
+    def target(self) -> pygame.Surface:
+        return self.game.screen if self.offscreen is None else self.offscreen
+
+    def set_target(self, surface: pygame.Surface = None):
+        self.flush()
+        self.offscreen = surface
+
+    def mark(self, rect: pygame.Rect):
+        if self.game.dirty_rects is not None and self.offscreen is None:
+            self.game.dirty_rects.add(rect)
+
+    # for a draw that covers the whole screen, one full update is cheaper than its rects
+    def mark_all(self):
+        if self.game.dirty_rects is not None and self.offscreen is None:
+            self.game.dirty_rects.invalidate()
 
     def fill(self, color: (int, int, int)):
-        self.game.screen.fill(color)
+        if self.game.dirty_rects is not None and self.offscreen is None:
+            self.game.dirty_rects.restore(color)
+        else:
+            self.target.fill(color)
 
     def clear(self):
-        self.game.screen.fill((0, 0, 0))
+        self.fill((0, 0, 0))
 
     def draw_rect(self, rect: Rectangle, color: (int, int, int)):
-        pygame.draw.rect(self.game.screen, color, (rect.pos.x, rect.pos.y, rect.size.x, rect.size.y))
+        self.mark(pygame.draw.rect(self.target, color, (rect.pos.x, rect.pos.y, rect.size.x, rect.size.y)))
 
     def draw_rect_border(self, rect: Rectangle, color: (int, int, int), width: int):
-        pygame.draw.rect(self.game.screen, color, (rect.pos.x, rect.pos.y, rect.size.x, rect.size.y), width)
+        self.mark(pygame.draw.rect(self.target, color, (rect.pos.x, rect.pos.y, rect.size.x, rect.size.y),
+                                   width))
 
     def draw_circle(self, circle: Circle, color: (int, int, int)):
-        pygame.draw.circle(self.game.screen, color, (int(circle.pos.x), int(circle.pos.y)), int(circle.radius))
+        self.mark(pygame.draw.circle(self.target, color, (int(circle.pos.x), int(circle.pos.y)),
+                                     int(circle.radius)))
+
+    def draw_circles(self, centers: [(int, int)], radii: [int], colors: [(int, int, int)]):
+        screen = self.target
+        circle = pygame.draw.circle
+        dirty_rects = self.game.dirty_rects
+        if dirty_rects is None or self.offscreen is not None:
+            for center, radius, color in zip(centers, radii, colors):
+                circle(screen, color, center, radius)
+        else:
+            for center, radius, color in zip(centers, radii, colors):
+                dirty_rects.add(circle(screen, color, center, radius))
+
+    # a circle pre-rendered with a colorkey, blitting it gives exactly the pixels of pygame.draw.circle
+    def circle_sprite(self, radius: int, color: (int, int, int)):
+        key = (radius, color)
+        sprite = self.circle_sprites.get(key)
+        if sprite is None:
+            sprite = pygame.Surface((radius * 2, radius * 2))
+            background = (255, 0, 255) if color == (0, 0, 0) else (0, 0, 0)
+            sprite.fill(background)
+            pygame.draw.circle(sprite, color, (radius, radius), radius)
+            if pygame.display.get_surface() is not None:
+                sprite = sprite.convert()
+            sprite.set_colorkey(background, pygame.RLEACCEL)
+            self.circle_sprites[key] = sprite
+        return sprite
+
+    def texture_key(self, img: pygame.Surface) -> int:
+        key = self.texture_keys.get(img)
+        if key is None:
+            key = self.texture_keys[img] = self.textures_seen
+            self.textures_seen += 1
+        return key
+
+    def queue_img_centered(self, img: pygame.Surface, pos: Vector2, layer: int = 0):
+        self.queue.append((layer, self.texture_key(img), img, (pos.x - img.get_width() / 2, pos.y - img.get_height() / 2)))
+
+    # the same image at many top left corners, e.g. every bullet of a BulletField
+    def queue_imgs(self, img: pygame.Surface, positions: [(int, int)], layer: int = 0):
+        key = self.texture_key(img)
+        self.queue.extend([(layer, key, img, pos) for pos in positions])
+
+    def queue_circles(self, centers: [(int, int)], radii: [int], colors: [(int, int, int)], layer: int = 0):
+        queue = self.queue
+        sprite = self.circle_sprite
+        for (x, y), radius, color in zip(centers, radii, colors):
+            if radius < 1:
+                continue
+            img = sprite(radius, tuple(color))
+            queue.append((layer, self.texture_key(img), img, (x - radius, y - radius)))
+
+    def flush(self):
+        if not self.queue:
+            return
+        with self.game.timer.scope("render.flush"):
+            self.queue.sort(key=lambda command: (command[0], command[1]))
+            dirty_rects = self.game.dirty_rects
+            if dirty_rects is None or self.offscreen is not None:
+                self.target.blits([(img, pos) for _, _, img, pos in self.queue], False)
+            else:
+                for rect in self.target.blits([(img, pos) for _, _, img, pos in self.queue]):
+                    dirty_rects.add(rect)
+            self.queue.clear()
 
     def draw_line(self, start: Vector2, end: Vector2, color: (int, int, int)):
-        pygame.draw.line(self.game.screen, color, (int(start.x), int(start.y)), (int(end.x), int(end.y)))
+        self.mark(pygame.draw.line(self.target, color, (int(start.x), int(start.y)), (int(end.x), int(end.y))))
 
     def draw_polygon(self, points: [Vector2], color: (int, int, int)):
-        pygame.draw.polygon(self.game.screen, color, [(int(point.x), int(point.y)) for point in points])
+        self.mark(pygame.draw.polygon(self.target, color, [(int(point.x), int(point.y)) for point in points]))
 
     def draw_text(self, text: str, pos: Vector2, color: (int, int, int), font: pygame.font.Font):
-        rendered_text = font.render(text, True, color)
-        self.game.screen.blit(rendered_text, (pos.x, pos.y))
+        rendered_text = self.game.fonts.render(font, text, color)
+        self.mark(self.target.blit(rendered_text, (pos.x, pos.y)))
 
     def draw_text_centered(self, text: str, pos: Vector2, color: (int, int, int), font: pygame.font.Font):
-        rendered_text = font.render(text, True, color)
-        self.game.screen.blit(rendered_text,
-                              (pos.x - rendered_text.get_width() / 2, pos.y - rendered_text.get_height() / 2))
+        rendered_text = self.game.fonts.render(font, text, color)
+        self.mark(self.target.blit(rendered_text, (pos.x - rendered_text.get_width() / 2,
+                                                        pos.y - rendered_text.get_height() / 2)))
 
     def draw_img(self, img: pygame.Surface, pos: Vector2):
-        self.game.screen.blit(img, (pos.x, pos.y))
+        self.mark(self.target.blit(img, (pos.x, pos.y)))
 
     def draw_img_centered(self, img: pygame.Surface, pos: Vector2):
-        self.game.screen.blit(img, (pos.x - img.get_width() / 2, pos.y - img.get_height() / 2))
+        self.mark(self.target.blit(img, (pos.x - img.get_width() / 2, pos.y - img.get_height() / 2)))
 
     def draw_img_rotated(self, img: pygame.Surface, pos: Vector2, angle: float):
-        self.game.screen.blit(pygame.transform.rotate(img, angle), (pos.x, pos.y))
+        self.mark(self.target.blit(self.game.rotations.get(img, angle), (pos.x, pos.y)))
 
     def draw_img_rotated_centered(self, img: pygame.Surface, pos: Vector2, angle: float):
-        self.game.screen.blit(pygame.transform.rotate(img, angle),
-                              (pos.x - img.get_width() / 2, pos.y - img.get_height() / 2))
+        # rotating grows the surface, so center on the rotated size
+        rotated = self.game.rotations.get(img, angle)
+        self.mark(self.target.blit(rotated, (pos.x - rotated.get_width() / 2,
+                                                  pos.y - rotated.get_height() / 2)))
+
+
+# a surface that build only redraws when the key changes, e.g. a HUD showing a few values
+# build draws through the renderer, which points at the layer meanwhile; pixels blended onto fully transparent ones
+# are stored as they are, so drawing the layer gives the same pixels as drawing its contents directly (+-1 rounding)
+class CachedLayer:
+    def __init__(self, renderer, size: (int, int)):
+        self.renderer = renderer
+        self.surface = pygame.Surface(size, pygame.SRCALPHA)
+        self.key = None
+        self.valid = False
+        self.builds = 0
+
+    def invalidate(self):
+        self.valid = False
+
+    def refresh(self, key, build):
+        if self.valid and key == self.key:
+            return
+        self.key = key
+        self.valid = True
+        self.builds += 1
+        # drawn on without run length encoding, pygame blends onto an encoded surface without keeping colors straight
+        self.surface.set_alpha(255)
+        self.surface.fill((0, 0, 0, 0))
+        previous = self.renderer.offscreen
+        self.renderer.set_target(self.surface)
+        try:
+            build()
+        finally:
+            self.renderer.set_target(previous)
+        # blitting skips the transparent runs instead of blending every pixel
+        self.surface.set_alpha(255, pygame.RLEACCEL)
+
+    def draw(self, pos: Vector2):
+        self.renderer.draw_img(self.surface, pos)
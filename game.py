@@ -1,26 +1,70 @@
+import argparse
 import math
 import random
 
 import pygame
 
 import engine
-from engine import Vector2, Rectangle, Circle
+from engine import Vector2, Rectangle
 from ui import Button, CheckBox
 
+# render queue layers of the game, lower layers are drawn first
+# the starfield and explosion particles are drawn right away so they end up below all of them (pygame.draw.circle
+# beats blitting pre-rendered circles for the big particles), the HUD is drawn after the queue is flushed
+LAYER_PICKUPS = 0
+LAYER_PROJECTILES = 1
+LAYER_ENEMIES = 2
+LAYER_PLAYER = 3
+
+# parallax layers of the starfield as (star radius, scroll speed), far ones first
+STAR_LAYERS = [(2, 1), (3, 1.5), (4, 2)]
+# a star per layer for every this many pixels it scrolls, about as dense as the old one star per 5 ticks
+STAR_SPACING = 15
+# the HUD is two cached layers along the top of the screen, the lives on the left and the score on the right
+HUD_HEIGHT = 80
+SCORE_WIDTH = 300
+
+
+# stars drawn once onto a screen sized tile, stars near an edge are drawn on the other edge too so it wraps seamlessly
+# has its own random generator so the starfield doesn't change the gameplay's random sequence
+def star_tile(resolution: (int, int), radius: int, count: int, seed: int) -> pygame.Surface:
+    rng = random.Random(seed)
+    width, height = resolution
+    tile = pygame.Surface(resolution)
+    tile.fill((0, 0, 0))
+    for _ in range(count):
+        x = rng.randint(0, width)
+        y = rng.randrange(height)
+        color = (rng.randint(200, 255), rng.randint(200, 255), rng.randint(200, 255))
+        for wrapped in (y - height, y, y + height):
+            pygame.draw.circle(tile, color, (x, wrapped), radius)
+    if pygame.display.get_surface() is not None:
+        tile = tile.convert()
+    tile.set_colorkey((0, 0, 0), pygame.RLEACCEL)
+    return tile
+
 
 class SpaceShooter(engine.Game):
-    def __init__(self, resolution: (int, int)):
-        super().__init__(resolution)
+    def __init__(self, resolution: (int, int), headless: bool = False):
+        super().__init__(resolution, headless)
         self.set_state(MenuState(self))
         self.settings.load("settings.json")
+        self.waves = engine.WaveLibrary(self, "waves", ENEMY_TYPES)
+        # sprites come from the packed atlas when there is one, anything else is decoded in the background
+        # while the menu is up, so gameplay never waits on a PNG
+        self.assets.load_atlas("assets")
+        self.assets.preload_async("assets")
         if self.settings.is_empty():
             self.settings.set("resolution", resolution)
             self.settings.set("fullscreen", False)
             self.settings.save()
         else:
             self.resolution = self.settings.get("resolution")
-            if self.settings.get("fullscreen"):
+            if self.settings.get("fullscreen") and not self.headless:
                 pygame.display.toggle_fullscreen()
+        self.set_dirty_rects(self.settings.get_default("dirty_rects", False))
+        self.fps = self.settings.get_default("max_fps", 144)
+        self.preciseCollisions = self.settings.get_default("precise_collisions", False)
         pygame.display.set_caption("Space Shooters")
 
     def update(self):
@@ -36,7 +80,7 @@ class MenuState(engine.GameState):
 
     def initialize(self):
         super().initialize()
-        font = pygame.font.SysFont("monospace", 60)
+        font = self.game.fonts.get_font("monospace", 60)
         play = Button(self, Vector2(self.game.resolution[0] / 2, 310), Vector2(400, 100), "Play", font, (133, 133, 133),
                       (200, 200, 200), (230, 230, 230))
         play.on_click = lambda: self.game.set_state(GameState(self.game))
@@ -55,26 +99,14 @@ class MenuState(engine.GameState):
         super().draw()
         center = Vector2(self.game.resolution[0] / 2, 100)
         self.renderer.draw_rect(Rectangle(center - Vector2(300, 50), Vector2(600, 100)), (133, 133, 133))
-        font = pygame.font.SysFont("monospace", 60)
+        font = self.game.fonts.get_font("monospace", 60)
         self.renderer.draw_text_centered("Space Shooters", center, (255, 255, 255), font)
-
-
-class StarParticle(engine.GameObject):
-    def __init__(self, game: engine.GameState, center: Vector2, radius: float, color: (int, int, int)):
-        super().__init__(game)
-        self.center = center
-        self.radius = radius
-        self.color = color
-
-    def update(self):
-        super().update()
-        self.center.y += 1 * self.radius / 2
-        if self.center.y > self.game.resolution[1] + self.radius:
-            self.destroy()
-
-    def draw(self):
-        super().draw()
-        self.game.renderer.draw_circle(Circle(self.center, self.radius), self.color)
+        assets = self.game.assets
+        if assets.loading:
+            bar = Rectangle(Vector2(self.game.resolution[0] / 2 - 200, self.game.resolution[1] - 16), Vector2(400, 10))
+            self.renderer.draw_rect(Rectangle(bar.pos, Vector2(bar.size.x * assets.progress(), bar.size.y)),
+                                    (230, 230, 230))
+            self.renderer.draw_rect_border(bar, (230, 230, 230), 1)
 
 
 # will just move down and despawn when it goes off screen
@@ -84,10 +116,12 @@ class PowerPickup(engine.GameObject):
     def __init__(self, game: engine.GameState, center: Vector2):
         super().__init__(game)
         self.center = center
-        self.texture = pygame.image.load("assets/power.png")
+        self.previous = center.copy()
+        self.texture = self.game.assets.get_image("assets/power.png")
 
     def update(self):
         super().update()
+        self.previous.set(self.center.x, self.center.y)
         self.center.y += 2
         if self.center.y > self.game.resolution[1] + 50:
             self.destroy()
@@ -100,52 +134,48 @@ class PowerPickup(engine.GameObject):
 
     def draw(self):
         super().draw()
-        self.game.renderer.draw_img_centered(self.texture, self.center)
-
-
-# will just move (circle particle) in its direction while slowly decreasing in size
-class ExplosionParticle(engine.GameObject):
-    def __init__(self, game: engine.GameState, center: Vector2, radius: float, color: (int, int, int),
-                 direction: Vector2):
-        super().__init__(game)
-        self.center = center
-        self.radius = radius
-        self.color = color
-        self.direction = direction
-
-    def update(self):
-        super().update()
-        self.center += self.direction * 3
-        self.radius -= 0.5
-        if self.radius <= 0:
-            self.destroy()
-
-    def draw(self):
-        super().draw()
-        self.game.renderer.draw_circle(Circle(self.center, self.radius), self.color)
+        self.game.renderer.queue_img_centered(self.texture, self.previous.lerp(self.center, self.game.alpha),
+                                              LAYER_PICKUPS)
 
 
+# pooled, use GameState.spawn_player_bullet instead of creating these directly
 class PlayerBullet:
-    def __init__(self, game: engine.GameState, center: Vector2, velocity: Vector2 = Vector2(0, -10)):
+    def __init__(self, game: engine.GameState):
         self.game = game
-        self.center = center
-        self.velocity = velocity
+        self.center = Vector2(0, 0)
+        self.previous = Vector2(0, 0)
+        self.velocity = Vector2(0, -10)
         self.color = (200, 200, 255)
-        self.sprite = pygame.image.load("assets/shot.png")
+        self.sprite = game.game.assets.get_image("assets/shot.png")
         self.size = Vector2(10, 33)
-        self.hitbox = Rectangle(self.center - self.size / 2, self.size)
+        self.hitbox = Rectangle(Vector2(0, 0), self.size)
+        # the hitbox before this tick's move and the box covering the whole move, for swept collisions
+        self.startBox = Rectangle(Vector2(0, 0), self.size)
+        self.sweptBox = Rectangle(Vector2(0, 0), self.size.copy())
         self.dead = False
         self.friendly = True
-        game.projectiles.append(self)
+
+    def reset(self, x: float, y: float, vx: float, vy: float):
+        self.center.set(x, y)
+        self.previous.set(x, y)
+        self.velocity.set(vx, vy)
+        self.hitbox.center_at(x, y)
+        self.startBox.center_at(x, y)
+        self.hitbox.swept(Vector2(0, 0), self.sweptBox)
+        self.dead = False
 
     def update(self):
+        self.previous.set(self.center.x, self.center.y)
         self.center += self.velocity
         if self.center.y < -self.size.y / 2:
             self.dead = True
-        self.hitbox = Rectangle(self.center - self.size / 2, self.size)
+        self.hitbox.center_at(self.center.x, self.center.y)
+        self.startBox.center_at(self.previous.x, self.previous.y)
+        self.startBox.swept(self.velocity, self.sweptBox)
 
     def draw(self):
-        self.game.renderer.draw_img_centered(self.sprite, self.center)
+        self.game.renderer.queue_img_centered(self.sprite, self.previous.lerp(self.center, self.game.game.alpha),
+                                              LAYER_PROJECTILES)
 
 
 class Player(engine.GameObject):
@@ -158,14 +188,22 @@ class Player(engine.GameObject):
         self.deadTimer = 0
         self.lives = 3
         self.position = position
+        self.previous = position.copy()
         self.velocity = Vector2(0, 0)
         self.shotCd = 0
-        self.texture = pygame.image.load("assets/spaceship.png")
-        self.lifeTexture = pygame.image.load("assets/heart.png")
-        self.hitbox = Rectangle(self.position - Vector2(10, 15), Vector2(20, 35))
+        self.texture = self.game.assets.get_image("assets/spaceship.png")
+        self.lifeTexture = self.game.assets.get_image("assets/heart.png")
+        # a forgiving box around the cockpit, or the whole sprite when its pixels decide what hits
+        if self.state.preciseCollisions:
+            self.hitboxOffset = Vector2(self.texture.get_width() / 2, self.texture.get_height() / 2)
+            self.hitbox = Rectangle(self.position - self.hitboxOffset, Vector2(*self.texture.get_size()))
+        else:
+            self.hitboxOffset = Vector2(10, 15)
+            self.hitbox = Rectangle(self.position - self.hitboxOffset, Vector2(20, 35))
         self.immuneFrames = 0
 
     def update(self):
+        self.previous.set(self.position.x, self.position.y)
         if self.dead:
             self.deadTimer += 1
             if self.deadTimer >= 240:
@@ -198,16 +236,16 @@ class Player(engine.GameObject):
 
         if self.game.keyboard.is_down(pygame.K_SPACE) and self.shotCd == 0:
             if self.power < 10:
-                b = PlayerBullet(self.state, Vector2(self.position.x, self.position.y - 40))
+                self.state.spawn_player_bullet(self.position.x, self.position.y - 40)
             elif self.power < 25:
-                b = PlayerBullet(self.state, Vector2(self.position.x - 10, self.position.y - 40))
-                b = PlayerBullet(self.state, Vector2(self.position.x + 10, self.position.y - 40))
+                self.state.spawn_player_bullet(self.position.x - 10, self.position.y - 40)
+                self.state.spawn_player_bullet(self.position.x + 10, self.position.y - 40)
             else:
-                b = PlayerBullet(self.state, Vector2(self.position.x - 10, self.position.y - 40), Vector2(-10, -10))
-                b = PlayerBullet(self.state, Vector2(self.position.x + 10, self.position.y - 40), Vector2(10, -10))
-                b = PlayerBullet(self.state, Vector2(self.position.x, self.position.y - 40))
+                self.state.spawn_player_bullet(self.position.x - 10, self.position.y - 40, -10, -10)
+                self.state.spawn_player_bullet(self.position.x + 10, self.position.y - 40, 10, -10)
+                self.state.spawn_player_bullet(self.position.x, self.position.y - 40)
             self.shotCd = 10
-        self.hitbox = Rectangle(self.position - Vector2(10, 15), Vector2(20, 35))
+        self.hitbox.move_to(self.position.x - self.hitboxOffset.x, self.position.y - self.hitboxOffset.y)
 
     def on_hit(self, entity):
         if self.immuneFrames > 0 or self.dead:
@@ -218,7 +256,8 @@ class Player(engine.GameObject):
         for i in range(30):
             rot = math.radians(random.randint(-15, 15))
             direction = Vector2(math.cos(dirRot + rot), math.sin(dirRot + rot)) * random.randint(1, 4)
-            e = ExplosionParticle(self.state, self.position, random.randint(5, 8), (200, 200, 255), direction)
+            self.state.particles.emit(self.position.x, self.position.y, direction.x * 3, direction.y * 3,
+                                      random.randint(5, 8), (200, 200, 255), 0.5)
 
 
         self.immuneFrames = 60
@@ -229,62 +268,47 @@ class Player(engine.GameObject):
             self.velocity = Vector2(0, 0)
             for i in range(36):
                 direction = Vector2(math.cos(math.radians(i * 10)), math.sin(math.radians(i * 10)))
-                e = ExplosionParticle(self.state, self.position, 15, (200, 200, 255), direction * 1)
-                e = ExplosionParticle(self.state, self.position, 10, (200, 200, 255), direction * 2)
+                self.state.particles.emit(self.position.x, self.position.y, direction.x * 3, direction.y * 3, 15,
+                                          (200, 200, 255), 0.5)
+                self.state.particles.emit(self.position.x, self.position.y, direction.x * 6, direction.y * 6, 10,
+                                          (200, 200, 255), 0.5)
 
     def draw(self):
         super().draw()
 
 
-class EnemyBullet:
-    def __init__(self, game: engine.GameState, center: Vector2):
-        self.game = game
-        self.center = center
-        self.color = (255, 64, 64)
-        self.size = Vector2(20, 20)
-        self.hitbox = Rectangle(self.center - self.size / 2, self.size)
-        self.dead = False
-        self.friendly = False
-        game.projectiles.append(self)
-
-    def update(self):
-        self.center += self.velocity
-        if (self.center.y > self.game.game.resolution[1] + self.size.y / 2) or (self.center.y < -self.size.y / 2) \
-                or (self.center.x > self.game.game.resolution[0] + self.size.x / 2) or (
-                self.center.x < -self.size.x / 2):
-            self.dead = True
-
-        self.hitbox = Rectangle(self.center - self.size / 2, self.size)
-
-    def draw(self):
-        # circle
-        self.game.renderer.draw_circle(Circle(self.center, self.size.x / 2), self.color)
-
-
 # not a game object because it has collision with the player
+# the class attributes are the balancing knobs, sweep.py overrides them per run
 class Enemy:
+    startHealth = 1
+    shootInterval = 60
+    bulletSpeed = 7
+
     def __init__(self, game: engine.GameState, center: Vector2):
         self.game = game
         self.center = center
+        self.previous = center.copy()
         self.velocity = Vector2(0, 0)
         self.dead = False
-        self.texture = pygame.image.load("assets/enemy.png")
+        self.texture = game.game.assets.get_image("assets/enemy.png")
         self.size = Vector2(90, 75)
-        self.hitbox = Rectangle(self.center - self.size / 2, self.size)
+        # the box has to cover the whole sprite when its pixels decide what hits
+        hitboxSize = Vector2(*self.texture.get_size()) if game.preciseCollisions else self.size
+        self.hitbox = Rectangle(self.center - hitboxSize / 2, hitboxSize)
         self.shootTimer = 0
-        self.health = 1
+        self.health = self.startHealth
         game.enemies.append(self)
 
     def update(self):
         self.center += self.velocity
-        self.hitbox = Rectangle(self.center - self.size / 2, self.size)
+        self.hitbox.center_at(self.center.x, self.center.y)
 
         self.shootTimer += 1
-        if self.shootTimer >= 60:
+        if self.shootTimer >= self.shootInterval:
             target = self.game.player.position
             direction = (target - self.center).normalized()
-            b = EnemyBullet(self.game, self.center + Vector2(0, self.size.y / 2))
-            b.velocity = direction * 7
+            self.game.spawn_enemy_bullet(self.center.x, self.center.y + self.size.y / 2,
+                                         direction.x * self.bulletSpeed, direction.y * self.bulletSpeed)
             self.shootTimer = 0
 
     def on_hit(self, entity):
@@ -296,29 +320,36 @@ class Enemy:
         for i in range(30):
             rot = math.radians(random.randint(-15, 15))
             direction = Vector2(math.cos(dirRot + rot), math.sin(dirRot + rot)) * random.randint(1, 4)
-            e = ExplosionParticle(self.game, self.center, random.randint(5, 8), (255, 200, 200), direction)
+            self.game.particles.emit(self.center.x, self.center.y, direction.x * 3, direction.y * 3,
+                                     random.randint(5, 8), (255, 200, 200), 0.5)
         if self.health <= 0:
             self.dead = True
             for i in range(36):
                 direction = Vector2(math.cos(math.radians(i * 10)), math.sin(math.radians(i * 10)))
-                e = ExplosionParticle(self.game, self.center, 15, (255, 200, 200), direction * 1)
-                e = ExplosionParticle(self.game, self.center, 10, (255, 200, 200), direction * 2)
-            p = PowerPickup(self.game, self.center)
+                self.game.particles.emit(self.center.x, self.center.y, direction.x * 3, direction.y * 3, 15,
+                                         (255, 200, 200), 0.5)
+                self.game.particles.emit(self.center.x, self.center.y, direction.x * 6, direction.y * 6, 10,
+                                         (255, 200, 200), 0.5)
+            p = PowerPickup(self.game, self.center.copy())
             self.game.score += 100
         else:
             self.game.score += 10
 
     def draw(self):
-        self.game.renderer.draw_img_centered(self.texture, self.center)
+        self.game.renderer.queue_img_centered(self.texture, self.previous.lerp(self.center, self.game.game.alpha),
+                                              LAYER_ENEMIES)
 
 
 # will just go into the screen, shoot a few times, then go away and despawn
 class AppearShootEnemy(Enemy):
+    startHealth = 3
+    shootInterval = 30
+    bulletSpeed = 4
+
     def __init__(self, game: engine.GameState, center: Vector2):
         super().__init__(game, center)
         self.velocity = Vector2(0, 5)
         self.actionTimer = 0
-        self.health = 3
 
     def update(self):
         self.actionTimer += 1
@@ -326,27 +357,28 @@ class AppearShootEnemy(Enemy):
             self.velocity.y -= 0.1
         elif self.actionTimer < 200:
             self.shootTimer += 1
-            if self.shootTimer >= 30:
+            if self.shootTimer >= self.shootInterval:
                 target = self.game.player.position
                 direction = (target - self.center).normalized()
-                b = EnemyBullet(self.game, self.center + Vector2(0, self.size.y / 2))
-                b.velocity = direction * 4
+                self.game.spawn_enemy_bullet(self.center.x, self.center.y + self.size.y / 2,
+                                             direction.x * self.bulletSpeed, direction.y * self.bulletSpeed)
                 self.shootTimer = 0
         elif self.actionTimer < 250:
             self.velocity.y -= 0.1
         else:
             self.dead = True
         self.center += self.velocity
-        self.hitbox = Rectangle(self.center - self.size / 2, self.size)
+        self.hitbox.center_at(self.center.x, self.center.y)
 
 
 # will simply go by the screen while slowly shooting
 class WalkShootEnemy(Enemy):
+    startHealth = 2
+
     def __init__(self, game: engine.GameState, center: Vector2):
         super().__init__(game, center)
         self.velocity = Vector2(0, 0)
         self.actionTimer = 0
-        self.health = 2
 
     def update(self):
         self.actionTimer += 1
@@ -357,143 +389,109 @@ class WalkShootEnemy(Enemy):
             self.shootTimer = 1
             target = self.game.player.position
             direction = target.x > self.center.x and Vector2(1, 0) or Vector2(-1, 0)
-            b = EnemyBullet(self.game, self.center + Vector2(0, self.size.y / 2))
-            b.velocity = direction * 7
+            self.game.spawn_enemy_bullet(self.center.x, self.center.y + self.size.y / 2,
+                                         direction.x * self.bulletSpeed, direction.y * self.bulletSpeed)
 
         if abs(self.center.x - self.game.player.position.x) < 25 and self.shootTimer == 0:
             self.shootTimer = 1
             target = self.game.player.position
             direction = target.y > self.center.y and Vector2(0, 1) or Vector2(0, -1)
-            b = EnemyBullet(self.game, self.center + Vector2(0, self.size.y / 2))
-            b.velocity = direction * 7
+            self.game.spawn_enemy_bullet(self.center.x, self.center.y + self.size.y / 2,
+                                         direction.x * self.bulletSpeed, direction.y * self.bulletSpeed)
 
         self.center += self.velocity
-        self.hitbox = Rectangle(self.center - self.size / 2, self.size)
+        self.hitbox.center_at(self.center.x, self.center.y)
         if self.center.y > self.game.game.resolution[1] + self.size.y / 2:
             self.dead = True
 
 
-class EnemyLayout:
-    def __init__(self, game: engine.GameState):
-        self.game = game
-        self.timer = 0
-
-    def update(self):
-        self.timer += 1
-
-
-class EnemyLayout1(EnemyLayout):
-    def __init__(self, game: engine.GameState):
-        super().__init__(game)
-        for i in range(3):
-            pos = self.game.game.resolution[0] / 4 * (i + 1)
-            e = AppearShootEnemy(self.game, Vector2(pos, -50))
-        self.timer = 0
-
-    def update(self):
-        super().update()
-        if self.timer == 200:
-            for i in range(4):
-                pos = self.game.game.resolution[0] / 5 * (i + 1)
-                e = AppearShootEnemy(self.game, Vector2(pos, -50))
-        if self.timer == 400:
-            for i in range(5):
-                pos = self.game.game.resolution[0] / 6 * (i + 1)
-                e = AppearShootEnemy(self.game, Vector2(pos, -50))
-        # repeat (placeholder)
-        if self.timer == 600:
-            self.game.currentEnemyLayout = EnemyLayout2(self.game)
-
-
-class EnemyLayout2(EnemyLayout):
-    def __init__(self, game: engine.GameState):
-        super().__init__(game)
-        self.timer2 = 0
-
-    def update(self):
-        super().update()
-        self.timer2 += 1
-        if self.timer2 == 100:
-            self.timer2 = 0
-            self.game.enemies.append(WalkShootEnemy(self.game, Vector2(50, 0)))
-            self.game.enemies.append(WalkShootEnemy(self.game, Vector2(self.game.game.resolution[0] - 50, 0)))
-
-        if self.timer == 200:
-            for i in range(2):
-                pos = self.game.game.resolution[0] / 3 * (i + 1)
-                e = AppearShootEnemy(self.game, Vector2(pos, -50))
-        if self.timer == 400:
-            for i in range(3):
-                pos = self.game.game.resolution[0] / 4 * (i + 1)
-                e = AppearShootEnemy(self.game, Vector2(pos, -50))
-        if self.timer == 600:
-            for i in range(2):
-                pos = self.game.game.resolution[0] / 3 * (i + 1)
-                e = AppearShootEnemy(self.game, Vector2(pos, -50))
-        if self.timer == 800:
-            for i in range(3):
-                pos = self.game.game.resolution[0] / 4 * (i + 1)
-                e = AppearShootEnemy(self.game, Vector2(pos, -50))
-        if self.timer == 1000:
-            self.game.currentEnemyLayout = EnemyLayout3(self.game)
-
-
-class EnemyLayout3(EnemyLayout):
-    def __init__(self, game: engine.GameState):
-        super().__init__(game)
-        self.timer2 = 0
-        self.direction = 1
-
-    def update(self):
-        super().update()
-        self.timer2 += 1
-        if self.timer2 == 75:
-            self.timer2 = 0
-            pos = self.direction == 1 and 50 or self.game.game.resolution[0] - 50
-            self.game.enemies.append(WalkShootEnemy(self.game, Vector2(pos, 0)))
-            self.direction *= -1
-        start = self.game.game.resolution[0] / 8
-        if self.timer == 75:
-            e = AppearShootEnemy(self.game, Vector2(start, -50))
-        if self.timer == 100:
-            e = AppearShootEnemy(self.game, Vector2(start * 2, -50))
-        if self.timer == 125:
-            e = AppearShootEnemy(self.game, Vector2(start * 3, -50))
-        if self.timer == 150:
-            e = AppearShootEnemy(self.game, Vector2(start * 4, -50))
-        if self.timer == 175:
-            e = AppearShootEnemy(self.game, Vector2(start * 5, -50))
-        if self.timer == 200:
-            e = AppearShootEnemy(self.game, Vector2(start * 6, -50))
-        if self.timer == 225:
-            e = AppearShootEnemy(self.game, Vector2(start * 7, -50))
+# names used for the enemy field of the wave files in waves/
+ENEMY_TYPES = {
+    "AppearShoot": AppearShootEnemy,
+    "WalkShoot": WalkShootEnemy,
+}
 
 
 class GameState(engine.GameState):
     def __init__(self, game: engine.Game):
         super().__init__(game)
-        self.starTimer = 0
-        self.tutorialText = pygame.image.load("assets/tooltip_text.png")
+        # boxes only pick the candidates and the sprites' pixels have to overlap, see touching
+        self.preciseCollisions = self.game.preciseCollisions
+        self.tutorialText = self.game.assets.get_image("assets/tooltip_text.png")
         self.tutorialTimer = 120
         self.player = Player(self, Vector2(self.game.resolution[0] / 2, self.game.resolution[1] - 100))
+        self.stars = [engine.ScrollingLayer(self, star_tile(self.game.resolution, radius, int(
+            self.game.resolution[1] / speed / STAR_SPACING), radius), speed) for radius, speed in STAR_LAYERS]
+        self.particles = engine.ParticleEmitter(self, 1024)
         self.score = 0
         self.drawnScore = 0
+        self.livesLayer = engine.CachedLayer(self.renderer, (self.game.resolution[0] // 2, HUD_HEIGHT))
+        self.scoreLayer = engine.CachedLayer(self.renderer, (SCORE_WIDTH, HUD_HEIGHT))
 
-        self.projectiles = []
-        self.enemies = []
-        self.currentEnemyLayout = EnemyLayout1(self)
+        self.projectiles = engine.EntityList()
+        self.playerBullets = engine.Pool(lambda: PlayerBullet(self), 64)
+        self.enemyBullets = engine.BulletField(self, Vector2(20, 20), (255, 64, 64), layer=LAYER_PROJECTILES)
+        self.enemies = engine.EntityList()
+        self.enemyGrid = engine.SpatialHash(128)
+        self.wave = None
+        self.start_wave("wave1")
 
     def initialize(self):
         super().initialize()
 
+    def handle_event(self, event):
+        # F5 reloads the wave files and restarts the current wave with the new version, a broken file keeps the old one
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_F5:
+            self.game.waves.reload()
+            self.start_wave(self.wave.script.name)
+        super().handle_event(event)
+
+    def start_wave(self, name: str):
+        self.wave = engine.WaveRunner(self.game.waves.get(name), self.spawn_enemy, self.game.resolution,
+                                     self.game.handle_error)
+
+    def spawn_enemy(self, kind: str, x: float, y: float):
+        return ENEMY_TYPES[kind](self, Vector2(x, y))
+
+    def entity_counts(self):
+        counts = super().entity_counts()
+        counts["projectiles"] = len(self.projectiles)
+        counts["enemy_bullets"] = len(self.enemyBullets)
+        counts["enemies"] = len(self.enemies)
+        counts["particles"] = len(self.particles)
+        return counts
+
+    # the narrow phase for boxes that already intersect, always true without precise collisions
+    def touching(self, imgA: pygame.Surface, centerA: Vector2, imgB: pygame.Surface, centerB: Vector2):
+        return not self.preciseCollisions or self.game.masks.overlap(imgA, centerA, imgB, centerB)
+
+    # enemies a projectile passed through during its last move, ordered by time of impact, so a fast projectile
+    # can't skip over an enemy between two ticks and hits the one it reached first
+    def projectile_hits(self, p):
+        hits = []
+        for e in self.enemyGrid.query(p.sweptBox):
+            times = p.startBox.sweep(p.velocity, e.hitbox)
+            if times is None:
+                continue
+            if self.preciseCollisions and not self.game.masks.overlap_along(p.sprite, p.previous, p.velocity,
+                                                                             times[0], times[1], e.texture, e.center):
+                continue
+            hits.append((times[0], e))
+        # sorted on the time alone so enemies hit at the same time keep their grid order
+        hits.sort(key=lambda hit: hit[0])
+        return hits
+
+    def spawn_player_bullet(self, x: float, y: float, vx: float = 0, vy: float = -10):
+        b = self.playerBullets.acquire(x, y, vx, vy)
+        self.projectiles.append(b)
+        return b
+
+    def spawn_enemy_bullet(self, x: float, y: float, vx: float, vy: float):
+        self.enemyBullets.spawn(x, y, vx, vy)
+
     def update(self):
         if self.tutorialTimer > 0:
             super().update()
-        self.starTimer += 1
-        if self.starTimer >= 5:
-            self.starTimer = 0
-            s = StarParticle(self, Vector2(random.randint(0, self.game.resolution[0]), -10), random.randrange(2, 5),
-                             (random.randint(200, 255), random.randint(200, 255), random.randint(200, 255)))
         super().update()
 
         if self.score != self.drawnScore:
@@ -502,56 +500,96 @@ class GameState(engine.GameState):
                 self.drawnScore = self.score
 
         if self.tutorialTimer > 0:
+            self.tutorialTimer -= 1
             return
 
-        self.currentEnemyLayout.update()
+        self.wave.update()
+        if self.wave.finished and self.wave.script.next is not None:
+            self.start_wave(self.wave.script.next)
 
-        for p in self.projectiles:
-            p.update()
-            if p.friendly:
-                for e in self.enemies:
-                    if p.hitbox.intersects(e.hitbox):
+        timer = self.game.timer
+        with timer.scope("projectiles"):
+            for p in self.projectiles:
+                p.update()
+            self.enemyBullets.update()
+
+        with timer.scope("collisions"):
+            # enemies only move in their own update, so the grid stays valid for the whole projectile pass
+            self.enemyGrid.clear()
+            for e in self.enemies:
+                self.enemyGrid.insert(e, e.hitbox)
+
+            for p in self.projectiles:
+                for _, e in self.projectile_hits(p):
+                    with timer.scope("Enemy.on_hit"):
                         e.on_hit(p)
+                    if p.dead:
+                        break
+                if p.dead:
+                    self.projectiles.remove(p)
+            # release after the flush, otherwise a bullet reused this tick would be dropped along with its old entry
+            for p in self.projectiles.flush():
+                self.playerBullets.release(p)
+
+            # swept relative to the player, who already moved this tick
+            motion = self.player.position - self.player.previous
+            if self.preciseCollisions:
+                self.enemyBullets.hit_test(self.player.hitbox, self.player.on_hit, self.player.texture,
+                                           self.player.position, motion)
             else:
-                if p.hitbox.intersects(self.player.hitbox):
-                    self.player.on_hit(p)
-            if p.dead:
-                self.projectiles.remove(p)
-
-        for e in self.enemies:
-            e.update()
-            if e.hitbox.intersects(self.player.hitbox):
-                self.player.on_hit(e)
-            if e.dead:
-                self.enemies.remove(e)
+                self.enemyBullets.hit_test(self.player.hitbox, self.player.on_hit, motion=motion)
+
+        with timer.scope("enemies"):
+            for e in self.enemies:
+                e.previous.set(e.center.x, e.center.y)
+                e.update()
+                if e.hitbox.intersects(self.player.hitbox) and \
+                        self.touching(e.texture, e.center, self.player.texture, self.player.position):
+                    self.player.on_hit(e)
+                if e.dead:
+                    self.enemies.remove(e)
+            self.enemies.flush()
 
     def draw(self):
         self.renderer.fill((0, 0, 0))
         if self.tutorialTimer > 0:
             self.renderer.draw_img_centered(self.tutorialText,
                                             Vector2(self.game.resolution[0] / 2, self.game.resolution[1] / 2))
-            self.tutorialTimer -= 1
         else:
+            font = self.game.fonts.get_font("monospace", 60)
             super().draw()
-            for p in self.projectiles:
-                p.draw()
-            for e in self.enemies:
-                e.draw()
-            # to make sure the player is drawn on top of the stars
+            timer = self.game.timer
+            with timer.scope("projectiles.draw"):
+                for p in self.projectiles:
+                    p.draw()
+                self.enemyBullets.draw()
+            with timer.scope("enemies.draw"):
+                for e in self.enemies:
+                    e.draw()
             if not self.player.immuneFrames % 4 != 0 and not self.player.dead:
-                self.game.renderer.draw_img_centered(self.player.texture, self.player.position)
-            elif self.player.dead:
+                self.game.renderer.queue_img_centered(self.player.texture,
+                                                      self.player.previous.lerp(self.player.position, self.game.alpha),
+                                                      LAYER_PLAYER)
+            self.game.renderer.flush()
+            # HUD
+            if self.player.dead:
                 self.game.renderer.draw_text_centered("Game Over",
                                                       Vector2(self.game.resolution[0] / 2, self.game.resolution[1] / 2),
-                                                      (255, 255, 255), pygame.font.SysFont("monospace", 60))
+                                                      (255, 255, 255), font)
+
+            self.livesLayer.refresh(self.player.lives, self.draw_lives)
+            self.livesLayer.draw(Vector2(0, 0))
+            self.scoreLayer.refresh(self.drawnScore, self.draw_score)
+            self.scoreLayer.draw(Vector2(self.game.resolution[0] - SCORE_WIDTH, 0))
 
-            # draw lives
-            for i in range(self.player.lives):
-                self.game.renderer.draw_img_centered(self.player.lifeTexture, Vector2(40 + i * 60, 40))
+    def draw_lives(self):
+        for i in range(self.player.lives):
+            self.renderer.draw_img_centered(self.player.lifeTexture, Vector2(40 + i * 60, 40))
 
-            # draw score
-            self.game.renderer.draw_text_centered(str(self.drawnScore), Vector2(self.game.resolution[0] - 100, 40),
-                                                  (255, 255, 255), pygame.font.SysFont("monospace", 60))
+    # centered 100 pixels from the right edge of the screen
+    def draw_score(self):
+        self.renderer.draw_text_centered(str(self.drawnScore), Vector2(SCORE_WIDTH - 100, 40), (255, 255, 255),
+                                         self.game.fonts.get_font("monospace", 60))
 
 
 # will have a back button and fullscreen checkbox (for now)
@@ -561,7 +599,7 @@ class SettingsState(engine.GameState):
 
     def initialize(self):
         super().initialize()
-        font = pygame.font.SysFont("monospace", 60)
+        font = self.game.fonts.get_font("monospace", 60)
         back = Button(self, Vector2(self.game.resolution[0] / 2, 530), Vector2(400, 100), "Back", font, (133, 133, 133),
                       (200, 200, 200), (230, 230, 230))
         back.on_click = lambda: self.game.set_state(MenuState(self.game))
@@ -581,9 +619,53 @@ class SettingsState(engine.GameState):
         super().draw()
         center = Vector2(self.game.resolution[0] / 2, 100)
         self.renderer.draw_rect(Rectangle(center - Vector2(300, 50), Vector2(600, 100)), (133, 133, 133))
-        font = pygame.font.SysFont("monospace", 60)
+        font = self.game.fonts.get_font("monospace", 60)
         self.renderer.draw_text_centered("Settings", center, (255, 255, 255), font)
 
 
-game = SpaceShooter((800, 600))
-game.run()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Space Shooters")
+    parser.add_argument("--headless", type=int, metavar="TICKS",
+                        help="simulate TICKS ticks of gameplay without a window and report ticks/sec")
+    parser.add_argument("--render", action="store_true", help="also draw every tick to the offscreen surface")
+    parser.add_argument("--seed", type=int, help="seed for the random module")
+    parser.add_argument("--record", metavar="PATH", help="record the session's input to PATH")
+    parser.add_argument("--replay", metavar="PATH", help="replay a recorded session without a window")
+    parser.add_argument("--capture", metavar="PATH",
+                        help="write every drawn frame to PATH, a pattern like frames/%%05d.png for --capture-format png")
+    parser.add_argument("--capture-format", choices=("raw", "png"), default="raw",
+                        help="raw is one file of rgb24 frames, png one image per frame")
+    args = parser.parse_args()
+    if args.seed is not None:
+        # the same seed a recording of the session stores, which has to fit an unsigned 64-bit field
+        args.seed %= 2 ** 64
+        random.seed(args.seed)
+    # frames are only drawn headlessly with --render
+    render = args.render or args.capture is not None
+    if args.replay:
+        game = SpaceShooter((800, 600), headless=True)
+        if args.capture:
+            game.start_capture(args.capture, args.capture_format, wait=True)
+        replay = engine.InputReplay(args.replay)
+        if replay.truncated:
+            print("{} ends early, replaying its first {} ticks".format(args.replay, replay.ticks))
+        result = game.replay(replay, render)
+        print("{ticks} ticks in {seconds:.3f}s ({ticks_per_second:.0f} ticks/sec)".format(**result))
+        game.quit()
+    elif args.headless:
+        game = SpaceShooter((800, 600), headless=True)
+        game.set_state(GameState(game))
+        if args.capture:
+            game.start_capture(args.capture, args.capture_format, wait=True)
+        result = game.simulate(args.headless, render)
+        print("{ticks} ticks in {seconds:.3f}s ({ticks_per_second:.0f} ticks/sec)".format(**result))
+        game.quit()
+    else:
+        game = SpaceShooter((800, 600))
+        if args.record:
+            game.start_recording(args.record, args.seed)
+        if args.capture:
+            game.start_capture(args.capture, args.capture_format)
+        game.run()
+        game.stop_recording()
+        game.stop_capture()
@@ -0,0 +1,63 @@
+import argparse
+import json
+import os
+
+import pygame
+
+from engine import IMAGE_EXTENSIONS, ATLAS_IMAGE, ATLAS_INDEX, ATLAS_RAW, asset_key
+
+PADDING = 1
+
+
+# shelf packing, tallest sprites first, rows are filled left to right until max_width
+def pack(sizes, max_width: int):
+    order = sorted(sizes, key=lambda name: (-sizes[name][1], name))
+    rects = {}
+    x = y = row_height = 0
+    width = 0
+    for name in order:
+        w, h = sizes[name]
+        if x > 0 and x + w > max_width:
+            x = 0
+            y += row_height + PADDING
+            row_height = 0
+        rects[name] = (x, y, w, h)
+        x += w + PADDING
+        row_height = max(row_height, h)
+        width = max(width, x - PADDING)
+    return rects, (width, y + row_height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="packs every sprite in a directory into one atlas image")
+    parser.add_argument("directory", nargs="?", default="assets")
+    parser.add_argument("--max-width", type=int, default=1024)
+    args = parser.parse_args()
+
+    generated = {ATLAS_IMAGE, ATLAS_INDEX, ATLAS_RAW}
+    images = {}
+    for root, _, names in os.walk(args.directory):
+        for name in sorted(names):
+            path = asset_key(os.path.join(root, name))
+            if name not in generated and name.lower().endswith(IMAGE_EXTENSIONS):
+                images[path] = pygame.image.load(path)
+    rects, size = pack({path: image.get_size() for path, image in images.items()}, args.max_width)
+
+    atlas = pygame.Surface(size, pygame.SRCALPHA)
+    atlas.fill((0, 0, 0, 0))
+    for path, (x, y, w, h) in rects.items():
+        # copied through RGBA bytes and max-blended onto the empty atlas so pixels land unblended, colorkeys included
+        rgba = pygame.image.frombytes(pygame.image.tobytes(images[path], "RGBA"), (w, h), "RGBA")
+        atlas.blit(rgba, (x, y), special_flags=pygame.BLEND_RGBA_MAX)
+    pygame.image.save(atlas, os.path.join(args.directory, ATLAS_IMAGE))
+    with open(os.path.join(args.directory, ATLAS_INDEX), "w") as file:
+        json.dump({"image": ATLAS_IMAGE, "size": size, "sprites": rects}, file, sort_keys=True)
+    # the raw pixel cache belongs to the old atlas image
+    raw = os.path.join(args.directory, ATLAS_RAW)
+    if os.path.exists(raw):
+        os.remove(raw)
+    print("packed {} sprites into a {}x{} atlas".format(len(rects), size[0], size[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import time
+
+import pygame
+
+import engine
+import game
+from benchmark import ScriptedInput, strafe_and_shoot, setup_play
+
+
+# bot policies, each returns the keys to hold this tick
+def idle(tick, state):
+    return set()
+
+
+def camp_and_shoot(tick, state):
+    return {pygame.K_SPACE}
+
+
+# shoots while sidestepping the closest enemy bullet heading its way
+def dodge(tick, state):
+    keys = {pygame.K_SPACE}
+    bullets = state.enemyBullets
+    if len(bullets) == 0:
+        return keys
+    player = state.player.position
+    positions = bullets.positions[:len(bullets)]
+    incoming = (positions[:, 1] < player.y) & (abs(positions[:, 0] - player.x) < 60)
+    if incoming.any():
+        closest = positions[incoming][positions[incoming][:, 1].argmax()]
+        keys.add(pygame.K_LEFT if closest[0] > player.x else pygame.K_RIGHT)
+    elif player.x < state.game.resolution[0] / 2 - 50:
+        keys.add(pygame.K_RIGHT)
+    elif player.x > state.game.resolution[0] / 2 + 50:
+        keys.add(pygame.K_LEFT)
+    return keys
+
+
+POLICIES = {
+    "idle": idle,
+    "camp": camp_and_shoot,
+    "strafe": strafe_and_shoot,
+    "dodge": dodge,
+}
+
+
+# applies "Class.attribute" overrides to the classes in game.py, the returned function undoes them
+def apply_params(params):
+    originals = []
+    for name, value in params.items():
+        cls_name, attribute = name.split(".")
+        cls = getattr(game, cls_name)
+        originals.append((cls, attribute, getattr(cls, attribute)))
+        setattr(cls, attribute, value)
+
+    def restore():
+        for cls, attribute, value in reversed(originals):
+            setattr(cls, attribute, value)
+
+    return restore
+
+
+# plays one session until the player dies or max_ticks pass, runs inside a worker process
+def run_session(job):
+    params, waves, policy, seed, max_ticks = job
+    restore = apply_params(params)
+    session = None
+    try:
+        random.seed(seed)
+        session = game.SpaceShooter((800, 600), headless=True)
+        if waves != session.waves.directory:
+            session.waves = engine.WaveLibrary(session, waves, game.ENEMY_TYPES)
+        state = setup_play(session)
+        keyboard = ScriptedInput(session)
+        script = POLICIES[policy]
+        start = time.perf_counter()
+        tick = 0
+        while tick < max_ticks and not state.player.dead:
+            keyboard.hold(script(tick, state))
+            session.update()
+            tick += 1
+        elapsed = time.perf_counter() - start
+    finally:
+        restore()
+        # not quit(), that would have every worker rewrite settings.json
+        if session is not None:
+            session.assets.shutdown()
+    return {"params": params, "waves": waves, "policy": policy, "seed": seed, "survived": not state.player.dead, "ticks": tick,
+            "score": state.score, "tick_ms": elapsed * 1000 / max(tick, 1)}
+
+
+def parse_values(text: str):
+    values = []
+    for value in text.split(","):
+        try:
+            values.append(json.loads(value))
+        except ValueError:
+            values.append(value)
+    return values
+
+
+# every combination of the --set values, e.g. ["AppearShootEnemy.startHealth=2,3", "Enemy.bulletSpeed=5,7"]
+def parameter_grid(settings):
+    names = []
+    choices = []
+    for setting in settings:
+        name, values = setting.split("=", 1)
+        names.append(name)
+        choices.append(parse_values(values))
+    return [dict(zip(names, combination)) for combination in itertools.product(*choices)]
+
+
+# running totals per parameter set, wave directory and policy, filled in as results stream back
+class Aggregate:
+    def __init__(self):
+        self.runs = 0
+        self.survived = 0
+        self.ticks = 0
+        self.score = 0
+        self.tick_ms = 0
+
+    def add(self, result):
+        self.runs += 1
+        self.survived += result["survived"]
+        self.ticks += result["ticks"]
+        self.score += result["score"]
+        self.tick_ms += result["tick_ms"] * result["ticks"]
+
+    def summary(self):
+        return {"runs": self.runs, "survival_rate": self.survived / self.runs,
+                "mean_survival_ticks": self.ticks / self.runs, "mean_score": self.score / self.runs,
+                "tick_ms": self.tick_ms / max(self.ticks, 1)}
+
+
+def worker_init():
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Space Shooter balancing sweeps")
+    parser.add_argument("--set", action="append", default=[], metavar="CLASS.ATTRIBUTE=V1,V2",
+                        help="values to sweep for a class attribute in game.py, can be given more than once")
+    parser.add_argument("--waves", action="append", metavar="DIRECTORY",
+                        help="directory of wave files to play, can be given more than once (default: waves)")
+    parser.add_argument("--policies", default="dodge", help="comma separated bot policies, any of {}".format(
+        ", ".join(POLICIES)))
+    parser.add_argument("--seeds", type=int, default=10, help="sessions per parameter set and policy")
+    parser.add_argument("--first-seed", type=int, default=1)
+    parser.add_argument("--ticks", type=int, default=3600, help="longest a session may last")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", default="sweep_results.json", help="where to write the aggregated results")
+    parser.add_argument("--runs", help="also write every single run as a line of JSON to this file")
+    args = parser.parse_args()
+    policies = args.policies.split(",")
+    for policy in policies:
+        if policy not in POLICIES:
+            parser.error("unknown policy: {}".format(policy))
+
+    grid = parameter_grid(args.set)
+    jobs = [(params, waves, policy, seed, args.ticks) for params in grid for waves in args.waves or ["waves"]
+            for policy in policies for seed in range(args.first_seed, args.first_seed + args.seeds)]
+    aggregates = {}
+    runs = open(args.runs, "w") if args.runs else None
+    start = time.perf_counter()
+    # not used as a context manager, its exit terminates the workers and pygame's parachute swallows SIGTERM
+    pool = multiprocessing.Pool(args.workers, worker_init)
+    try:
+        for done, result in enumerate(pool.imap_unordered(run_session, jobs, chunksize=4), 1):
+            key = (json.dumps(result["params"], sort_keys=True), result["waves"], result["policy"])
+            aggregates.setdefault(key, Aggregate()).add(result)
+            if runs is not None:
+                runs.write(json.dumps(result) + "\n")
+            if done % 100 == 0 or done == len(jobs):
+                print("{}/{} runs in {:.1f}s".format(done, len(jobs), time.perf_counter() - start))
+    finally:
+        pool.close()
+        pool.join()
+    if runs is not None:
+        runs.close()
+
+    results = []
+    for (params, waves, policy), aggregate in sorted(aggregates.items()):
+        summary = aggregate.summary()
+        results.append(dict(params=json.loads(params), waves=waves, policy=policy, **summary))
+        print("{} {} {}: survived {:.0%}, {:.0f} ticks, score {:.0f}, {:.3f} ms/tick".format(
+            params, waves, policy, summary["survival_rate"], summary["mean_survival_ticks"], summary["mean_score"],
+            summary["tick_ms"]))
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()